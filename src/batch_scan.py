@@ -0,0 +1,314 @@
+#!/bin/python3
+
+# Scan a directory (or glob) of screenshots using a pool of
+# worker processes, since template matching is CPU bound
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import argparse
+import glob
+import os
+import time
+
+import color_index
+import dedup
+import pikmin_image_parser
+import profiler
+import result_cache
+import result_writer
+import review_queue
+import stitch
+import template_atlas
+import template_ranking
+import template_registry
+import watch_folder
+
+# Reuse results of screenshots that were already scanned
+use_cache = True
+# Attributes that can have custom templates in the atlas
+custom_attributes = ["color", "friendship", "maturity", "decor"]
+
+# Turn a list of directories, files and globs into a
+# sorted list of screenshot paths
+def expand_inputs(inputs):
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for extension in ["jpg", "jpeg", "png"]:
+                paths.extend(glob.glob(os.path.join(item, "*."+extension)))
+        else:
+            paths.extend(glob.glob(item))
+
+    # Remove duplicates but keep a stable order
+    return sorted(set(paths))
+
+# Load every template set once when a worker starts so the
+# first screenshot handled by each worker is not slower
+def init_worker(headless=False, cache=True, decor=False):
+    global use_cache
+    use_cache = cache
+    pikmin_image_parser.headless = headless
+    pikmin_image_parser.detect_decor = decor
+    for attribute_name in ["heart", "color", "friendship", "maturity", "decor"]:
+        template_registry.get_templates(attribute_name)
+    color_index.get_index()
+
+# Keep the peak memory of each worker process in the profile
+def record_worker_memory():
+    rss = profiler.peak_rss_mb()
+    if rss is not None:
+        profiler.record_peak(f"worker {os.getpid()} peak rss mb", rss)
+
+# Pick up custom templates another process added to the atlas since
+# this one loaded it, like review_queue.py or another worker learning
+# from a prompt. Long running processes check before every screenshot
+def reload_custom_templates():
+    attributes = template_atlas.reload_if_changed()
+    if attributes is None:
+        attributes = set(custom_attributes)
+    for attribute_name in attributes:
+        template_registry.invalidate(attribute_name)
+    # Renamed pikmin are looked up in the color index, not the registry
+    if "color" in attributes:
+        color_index.invalidate()
+
+# Update the results of a screenshot scanned before custom templates
+# were learned, matching only the pikmin the new templates could change.
+# Returns None if the screenshot has to be scanned again
+def rescan_file(path, fingerprint, file_hash=None):
+    previous = result_cache.get_previous(path, file_hash)
+    if previous is None:
+        return None
+    records, base, atlas_state, scale, crops = previous
+    attributes = template_atlas.added_since(atlas_state)
+    if attributes is None or base != result_cache.base_fingerprint():
+        return None
+
+    with profiler.stage("rescan"):
+        template_registry.set_scale(scale)
+        crops = pikmin_image_parser.rescan_records(records, crops, attributes)
+    result_cache.put(path, records, fingerprint, crops, scale, file_hash)
+    result_cache.stats["rescans"] += 1
+
+    return records
+
+# Get the records of a screenshot, or of a group of stitched screenshots
+# under the group name, from the result cache if it was scanned before.
+# Otherwise identify(crops) scans it
+def get_records(name, identify, file_hash=None):
+    reload_custom_templates()
+    records = None
+    if use_cache:
+        fingerprint = result_cache.template_fingerprint()
+        if file_hash is None:
+            file_hash = result_cache.content_hash(name)
+        records = result_cache.get(name, fingerprint, file_hash)
+        if records is None:
+            records = rescan_file(name, fingerprint, file_hash)
+        # The same screenshot may have been scanned under another name
+        for record in records or []:
+            record["file"] = name
+    if records is None:
+        crops = {}
+        records = identify(crops)
+        if use_cache:
+            result_cache.put(name, records, fingerprint, crops, template_registry.scale, file_hash)
+    # Pikmin answered in review_queue.py since the scan. The cache keeps
+    # what was matched, so the answers are added every time
+    review_queue.apply_resolutions(name, records)
+
+    return records
+
+# Identify a single screenshot and time it, along with the
+# profiler measurements taken while identifying it
+def scan_file(path):
+    start = time.perf_counter()
+    records = get_records(path, lambda crops: pikmin_image_parser.identify_image(path, crops))
+    elapsed = time.perf_counter() - start
+    profiler.add_time("screenshot", elapsed)
+    record_worker_memory()
+
+    return path, records, elapsed, profiler.collect()
+
+# Crop a screenshot and find its heart rows for stitching, in a worker
+def prepare_file(path):
+    prepared = stitch.prepare_screenshot(path)
+    record_worker_memory()
+
+    return prepared, profiler.collect()
+
+# Identify a group of stitched screenshots and time it
+def scan_group(group):
+    start = time.perf_counter()
+    name = stitch.group_name(group[0])
+    file_hash = result_cache.group_hash(group[0]) if use_cache else None
+    records = get_records(name, lambda crops: stitch.identify_group(group, crops), file_hash)
+    elapsed = time.perf_counter() - start
+    profiler.add_time("screenshot group", elapsed)
+    record_worker_memory()
+
+    return name, records, elapsed, profiler.collect()
+
+# Prepare screenshots in order for stitch.group_screenshots,
+# adding the profiler measurements to this process
+def iter_prepared(prepared):
+    for result, measured in prepared:
+        profiler.merge(measured)
+        yield result
+
+# Identify all screenshots, yielding (path, records, seconds) for
+# each file in the same order as the input as soon as it is ready.
+# Profiler measurements from the workers are added to this process.
+# When stitching, overlapping screenshots are yielded as one group
+def iter_scan(paths, workers=None, headless=False, cache=True, stitched=False, decor=False):
+    if workers == 1:
+        # Run in this process, which keeps the prompts usable
+        init_worker(headless, cache, decor)
+        if stitched:
+            items = stitch.group_screenshots(iter_prepared(map(prepare_file, paths)))
+            scan_function = scan_group
+        else:
+            items = paths
+            scan_function = scan_file
+        for item in items:
+            path, records, elapsed, measured = scan_function(item)
+            profiler.merge(measured)
+            yield path, records, elapsed
+        return
+
+    # Prompts cannot be answered from worker processes
+    if not headless:
+        print("Running with multiple workers, unknown pikmin will be queued for review")
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(True, cache, decor)) as pool:
+        if not stitched:
+            for path, records, elapsed, measured in pool.map(scan_file, paths):
+                profiler.merge(measured)
+                yield path, records, elapsed
+            return
+
+        # Screenshots are cropped and searched for hearts in the workers.
+        # Grouping has to see them in order, so it is done here on the
+        # small results, and each group is sent back to be stitched and
+        # classified as soon as it is complete
+        scans = deque()
+        for group in stitch.group_screenshots(iter_prepared(pool.map(prepare_file, paths))):
+            scans.append(pool.submit(scan_group, group))
+            while len(scans) > 0 and scans[0].done():
+                path, records, elapsed, measured = scans.popleft().result()
+                profiler.merge(measured)
+                yield path, records, elapsed
+        while len(scans) > 0:
+            path, records, elapsed, measured = scans.popleft().result()
+            profiler.merge(measured)
+            yield path, records, elapsed
+
+# Identify all screenshots, returning (path, records, seconds)
+# for each file in the same order as the input. If a writer is given,
+# records are written as each screenshot finishes instead of returned.
+# If a deduplicator is given, pikmin already seen in an earlier
+# screenshot are dropped. If a profile path is given, the stage timings,
+# counters and cache hit rates of the run are saved there as JSON
+def scan_batch(paths, workers=None, headless=False, cache=True, writer=None, deduplicator=None, stitched=False,
+               profile_path=None, decor=False):
+    start = time.perf_counter()
+
+    results = []
+    timings = []
+    for path, records, file_elapsed in iter_scan(paths, workers, headless, cache, stitched, decor):
+        if deduplicator is not None:
+            records = deduplicator.filter(records)
+        timings.append((path, len(records), file_elapsed))
+        if writer is not None:
+            writer.write(records)
+        else:
+            results.append((path, records, file_elapsed))
+
+    elapsed = time.perf_counter() - start
+    print_timing(timings, elapsed, len(paths))
+    template_ranking.print_stats()
+    if deduplicator is not None:
+        deduplicator.print_stats()
+    if profile_path is not None:
+        images_per_sec = len(paths) / elapsed if elapsed > 0 else 0
+        profiler.dump(profile_path, run={"screenshots": len(paths), "workers": workers,
+                                         "seconds": round(elapsed, 4), "images_per_sec": round(images_per_sec, 4)})
+        print(f"Profile written to {profile_path}")
+
+    return results
+
+# Print how long each file took and the overall throughput
+def print_timing(timings, elapsed, image_count):
+    for path, pikmin_count, file_elapsed in timings:
+        print(f"{file_elapsed:7.2f}s  {pikmin_count:3d} pikmin  {path}")
+
+    images_per_sec = image_count / elapsed if elapsed > 0 else 0
+    print(f"Scanned {image_count} screenshots in {elapsed:.2f}s ({images_per_sec:.2f} images/sec)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan Pikmin Bloom challenge screenshots")
+    parser.add_argument("inputs", nargs="*", default=["../screenshots/"],
+                        help="screenshot files, directories or glob patterns")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--headless", action="store_true",
+                        help="queue unknown pikmin for review_queue.py instead of prompting")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="scan every screenshot even if it was scanned before")
+    parser.add_argument("--dedup", action="store_true",
+                        help="drop pikmin already seen in an earlier screenshot of the same challenge")
+    parser.add_argument("--challenge", choices=list(dedup.challenge_groupings), default="directory",
+                        help="with --dedup, which screenshots are from the same challenge: the ones in the same "
+                             "directory (default) or every screenshot of the run")
+    parser.add_argument("--stitch", action="store_true",
+                        help="stitch overlapping consecutive screenshots so each pikmin is only scanned once")
+    parser.add_argument("--decor", action="store_true",
+                        help="read whether pikmin wear decor, asking about every pikmin no decor template matches")
+    parser.add_argument("-o", "--output",
+                        help="file to write results to (.csv, .jsonl or .parquet)")
+    parser.add_argument("--format", choices=list(result_writer.writers),
+                        help="output format, if it cannot be told from the file extension")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and scan screenshots as they are added to the input directories")
+    parser.add_argument("--existing", action="store_true",
+                        help="with --watch, also scan the screenshots already in the directories")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="save stage timings, template match counts and cache hit rates of the run as JSON")
+    args = parser.parse_args()
+
+    if args.watch:
+        directories = [item for item in args.inputs if os.path.isdir(item)]
+        if len(directories) != len(args.inputs):
+            print("--watch needs directories to watch")
+            exit(1)
+        # Results are added to the output so the watcher can be restarted
+        writer = None
+        if args.output is not None:
+            writer = result_writer.open_writer(args.output, args.format, append=True)
+        try:
+            deduplicator = dedup.Deduplicator(grouping=args.challenge) if args.dedup else None
+            watch_folder.watch(directories, writer, args.headless, not args.no_cache, deduplicator, args.existing,
+                               decor=args.decor)
+            if args.profile is not None:
+                profiler.dump(args.profile)
+        finally:
+            if writer is not None:
+                writer.close()
+        exit(0)
+
+    paths = expand_inputs(args.inputs)
+    if len(paths) == 0:
+        print("No screenshots found")
+        exit(1)
+
+    writer = None
+    if args.output is not None:
+        writer = result_writer.open_writer(args.output, args.format)
+    try:
+        deduplicator = dedup.Deduplicator(grouping=args.challenge) if args.dedup else None
+        scan_batch(paths, args.workers, args.headless, not args.no_cache, writer, deduplicator, args.stitch,
+                   args.profile, args.decor)
+    finally:
+        if writer is not None:
+            writer.close()
@@ -0,0 +1,352 @@
+#!/bin/python3
+
+# Benchmark identify_image on the bundled screenshots. Checks the results
+# against the labelled pikmin in expected.json and measures throughput,
+# per stage latency and peak memory. Compared with a saved baseline, any
+# drop in speed or accuracy is flagged and the script exits with an error.
+#
+# Runs headless: pikmin that cannot be identified are left unknown and
+# queued to a temporary directory instead of prompting. Template wins are
+# counted in a temporary file, so the saved template order is not changed.
+#
+# Accuracy is scored with every screenshot scanned in a fresh process, so
+# it does not depend on what was scanned before. The timed runs share one
+# process, and any of their records that differ are reported.
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import argparse
+import atexit
+import contextlib
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pikmin_image_parser
+import profiler
+import review_queue
+import template_ranking
+
+expected_path = "../screenshots/expected.json"
+baseline_path = "../cache/benchmark_baseline.json"
+
+# Fields checked against the labels
+label_fields = ["color", "maturity", "hearts", "selected", "decor"]
+# Latency percentiles to report
+percentiles = [50, 90, 99]
+# Allowed change against the baseline before it counts as a regression
+tolerance = 0.15
+# Stages faster than this are too noisy to compare against the baseline
+min_stage_ms = 1.0
+
+# The benchmark must never wait for someone to answer a prompt
+def no_prompt(*args, **kwargs):
+    raise RuntimeError("Prompted for input during the benchmark")
+
+# Keep the real review queue and template ranking clean by using a
+# temporary directory, which is removed on exit unless it was given
+def use_headless(work_dir=None):
+    pikmin_image_parser.headless = True
+    pikmin_image_parser.prompt_user_color = no_prompt
+    pikmin_image_parser.prompt_user_maturity = no_prompt
+    pikmin_image_parser.prompt_user_friendship = no_prompt
+    pikmin_image_parser.prompt_user_decor = no_prompt
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="pikmin_benchmark_")
+        atexit.register(shutil.rmtree, work_dir, ignore_errors=True)
+    review_queue.pending_dir = os.path.join(work_dir, "review")
+    template_ranking.stats_path = os.path.join(work_dir, "template_ranking.sqlite")
+
+    return work_dir
+
+# Each fresh process starts from an empty template ranking of its own
+def init_fresh_worker(work_dir, decor):
+    use_headless(tempfile.mkdtemp(dir=work_dir))
+    pikmin_image_parser.detect_decor = decor
+
+# Fields checked in this run, decor is only read when asked for
+def scored_fields():
+    return [field for field in label_fields if field != "decor" or pikmin_image_parser.detect_decor]
+
+# Identify a screenshot without printing anything, returning the records
+# and how long it took
+def identify_quietly(path):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        records = pikmin_image_parser.identify_image(path)
+
+    return records, time.perf_counter() - start
+
+# Labels of a record, with unknown fields left unlabelled
+def record_labels(record):
+    labels = {}
+    for field in label_fields:
+        value = record[field]
+        labels[field] = None if value == pikmin_image_parser.UNKNOWN else value
+
+    return labels
+
+def load_expected(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+# Add labels for screenshots that are not labelled yet, taken from the
+# records of this run. Existing labels are kept, so corrections made by
+# hand are never overwritten
+def save_labels(path, expected, results):
+    for screenshot, records in results.items():
+        if screenshot not in expected:
+            expected[screenshot] = [record_labels(record) for record in records]
+            print(f"Labelled {len(records)} pikmin in {screenshot}")
+    # One pikmin per line keeps the file easy to correct by hand
+    lines = []
+    for screenshot, labels in sorted(expected.items()):
+        pikmin_lines = ",\n".join(f"  {json.dumps(pikmin_labels)}" for pikmin_labels in labels)
+        lines.append(f" {json.dumps(screenshot)}: [\n{pikmin_lines}\n ]")
+    with open(path, "w") as f:
+        f.write("{\n" + ",\n".join(lines) + "\n}\n")
+
+# Compare records with the labels. Returns {field: (correct, labelled)},
+# the number of labelled fields the scanner left unknown and the mistakes
+def score(expected, results):
+    totals = {field: [0, 0] for field in scored_fields()}
+    unknown = 0
+    mistakes = []
+    for screenshot, records in results.items():
+        if screenshot not in expected:
+            continue
+        labels = expected[screenshot]
+        if len(records) != len(labels):
+            mistakes.append(f"{screenshot}: found {len(records)} pikmin, expected {len(labels)}")
+        for i, labelled in enumerate(labels):
+            found = record_labels(records[i]) if i < len(records) else {}
+            for field in scored_fields():
+                if labelled[field] is None:
+                    continue
+                totals[field][1] += 1
+                if found.get(field) == labelled[field]:
+                    totals[field][0] += 1
+                else:
+                    if found.get(field) is None:
+                        unknown += 1
+                    mistakes.append(f"{screenshot} pikmin {i} {field}: {found.get(field)}, expected {labelled[field]}")
+
+    return {field: tuple(counts) for field, counts in totals.items()}, unknown, mistakes
+
+# Identify every screenshot in a process of its own, so nothing cached
+# or ranked while scanning one screenshot can change the records of
+# another. Returns {screenshot: records}
+def identify_fresh(paths, work_dir):
+    with ProcessPoolExecutor(max_tasks_per_child=1, initializer=init_fresh_worker,
+                             initargs=(work_dir, pikmin_image_parser.detect_decor)) as pool:
+        records = pool.map(identify_quietly, paths)
+
+    return {os.path.basename(path): screenshot_records for path, (screenshot_records, elapsed) in zip(paths, records)}
+
+# Describe each labelled field the timed runs got differently from the
+# fresh scans
+def compare_runs(fresh, warm):
+    differences = []
+    for screenshot, records in fresh.items():
+        warm_records = warm.get(screenshot, [])
+        if len(warm_records) != len(records):
+            differences.append(f"{screenshot}: found {len(warm_records)} pikmin, {len(records)} when scanned fresh")
+            continue
+        for i, (record, warm_record) in enumerate(zip(records, warm_records)):
+            for field in scored_fields():
+                if record[field] != warm_record[field]:
+                    differences.append(f"{screenshot} pikmin {i} {field}: {warm_record[field]}, "
+                                       f"{record[field]} when scanned fresh")
+
+    return differences
+
+# Time every screenshot repeat times. Returns the records of the first
+# run, the latency of each run and the stage timings of each run
+def time_screenshots(paths, repeat):
+    results = {}
+    latencies = []
+    stage_samples = {}
+    for run in range(repeat):
+        for path in paths:
+            profiler.reset()
+            records, elapsed = identify_quietly(path)
+            latencies.append(elapsed)
+            for name, (seconds, runs) in profiler.collect()["timings"].items():
+                stage_samples.setdefault(name, []).append(seconds)
+            if run == 0:
+                results[os.path.basename(path)] = records
+
+    return results, latencies, stage_samples
+
+# Largest amount of memory allocated while identifying one screenshot.
+# Done in its own pass since tracing slows everything down
+def measure_peak_memory(paths):
+    tracemalloc.start()
+    peak = 0
+    for path in paths:
+        tracemalloc.reset_peak()
+        identify_quietly(path)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+    return peak
+
+def latency_summary(samples):
+    summary = {f"p{q}_ms": round(float(np.percentile(samples, q)) * 1000, 3) for q in percentiles}
+    summary["mean_ms"] = round(float(np.mean(samples)) * 1000, 3)
+
+    return summary
+
+def run_benchmark(paths, repeat, expected, work_dir):
+    results = identify_fresh(paths, work_dir)
+
+    # Warm up the template caches so loading is not part of the timing
+    for path in paths[:1]:
+        identify_quietly(path)
+
+    start = time.perf_counter()
+    warm_results, latencies, stage_samples = time_screenshots(paths, repeat)
+    elapsed = time.perf_counter() - start
+
+    accuracy, unknown, mistakes = score(expected, results)
+    differences = compare_runs(results, warm_results)
+    correct = sum(counts[0] for counts in accuracy.values())
+    labelled = sum(counts[1] for counts in accuracy.values())
+
+    report = {
+        "screenshots": len(paths),
+        "repeat": repeat,
+        "images_per_sec": round(len(paths) * repeat / elapsed, 4),
+        "latency": latency_summary(latencies),
+        "stages": {name: latency_summary(samples) for name, samples in
+                   sorted(stage_samples.items(), key=lambda item: -sum(item[1]))},
+        "peak_memory_mb": round(measure_peak_memory(paths) / 2**20, 2),
+        "peak_rss_mb": profiler.peak_rss_mb(),
+        "accuracy": {field: round(counts[0] / counts[1], 4) if counts[1] > 0 else None
+                     for field, counts in accuracy.items()},
+        "overall_accuracy": round(correct / labelled, 4) if labelled > 0 else None,
+        "mistakes": len(mistakes),
+        "unknown": unknown,
+        "inconsistent": len(differences),
+    }
+
+    return report, results, mistakes, differences
+
+def print_report(report, mistakes, differences):
+    for mistake in mistakes:
+        print(f"MISTAKE {mistake}")
+    for difference in differences:
+        print(f"INCONSISTENT {difference}")
+    print(f"Scanned {report['screenshots']} screenshots {report['repeat']} times, "
+          f"{report['images_per_sec']:.2f} images/sec")
+    latency = report["latency"]
+    print(f"{'identify_image':24s} " + " ".join(f"p{q} {latency[f'p{q}_ms']:8.1f}ms" for q in percentiles))
+    for name, stage_latency in report["stages"].items():
+        print(f"{name:24s} " + " ".join(f"p{q} {stage_latency[f'p{q}_ms']:8.1f}ms" for q in percentiles))
+    print(f"Peak memory per screenshot: {report['peak_memory_mb']:.1f}MB")
+    if report["peak_rss_mb"] is not None:
+        print(f"Peak resident memory of the process: {report['peak_rss_mb']:.1f}MB")
+    for field, field_accuracy in report["accuracy"].items():
+        if field_accuracy is not None:
+            print(f"{field.capitalize()} accuracy: {field_accuracy:.1%}")
+    if report["overall_accuracy"] is not None:
+        print(f"Overall accuracy: {report['overall_accuracy']:.1%} "
+              f"({report['mistakes']} mistakes, {report['unknown']} left unknown)")
+    if report["inconsistent"] > 0:
+        print(f"{report['inconsistent']} fields changed when scanned after other screenshots")
+
+# Compare a report with the baseline, returning a description of
+# each regression
+def find_regressions(report, baseline):
+    regressions = []
+    if report["images_per_sec"] < baseline["images_per_sec"] * (1 - tolerance):
+        regressions.append(f"throughput {report['images_per_sec']:.2f} images/sec, "
+                           f"baseline {baseline['images_per_sec']:.2f}")
+    for name, stage_latency in report["stages"].items():
+        baseline_latency = baseline["stages"].get(name)
+        if baseline_latency is None or baseline_latency["p50_ms"] < min_stage_ms:
+            continue
+        if stage_latency["p50_ms"] > baseline_latency["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{name} p50 {stage_latency['p50_ms']:.1f}ms, baseline {baseline_latency['p50_ms']:.1f}ms")
+    if report["peak_memory_mb"] > baseline["peak_memory_mb"] * (1 + tolerance):
+        regressions.append(f"peak memory {report['peak_memory_mb']:.1f}MB, baseline {baseline['peak_memory_mb']:.1f}MB")
+    if report.get("peak_rss_mb") is not None and baseline.get("peak_rss_mb") is not None and \
+            report["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"peak resident memory {report['peak_rss_mb']:.1f}MB, baseline {baseline['peak_rss_mb']:.1f}MB")
+    # Accuracy is exact, any extra mistake is a regression
+    if report["mistakes"] > baseline["mistakes"]:
+        regressions.append(f"{report['mistakes']} mistakes, baseline {baseline['mistakes']}")
+    if report["inconsistent"] > baseline.get("inconsistent", 0):
+        regressions.append(f"{report['inconsistent']} fields depend on scan order, baseline {baseline.get('inconsistent', 0)}")
+    for field, field_accuracy in report["accuracy"].items():
+        baseline_accuracy = baseline["accuracy"].get(field)
+        if field_accuracy is not None and baseline_accuracy is not None and field_accuracy < baseline_accuracy:
+            regressions.append(f"{field} accuracy {field_accuracy:.1%}, baseline {baseline_accuracy:.1%}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark speed and accuracy on the bundled screenshots")
+    parser.add_argument("inputs", nargs="*", default=["../screenshots/*.jpg"],
+                        help="screenshot files or glob patterns")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of times to scan each screenshot")
+    parser.add_argument("--expected", default=expected_path,
+                        help="labelled pikmin of each screenshot")
+    parser.add_argument("--baseline", default=baseline_path,
+                        help="results of an earlier run to compare against")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="save this run as the baseline")
+    parser.add_argument("--label", action="store_true",
+                        help="label screenshots that are not in the expected file yet from this run")
+    parser.add_argument("--decor", action="store_true",
+                        help="also read and score decor, which is off when scanning by default")
+    parser.add_argument("--json", metavar="PATH",
+                        help="also save the report as JSON")
+    args = parser.parse_args()
+
+    paths = sorted(set(path for pattern in args.inputs for path in glob.glob(pattern)))
+    if len(paths) == 0:
+        print("No screenshots found")
+        sys.exit(1)
+
+    pikmin_image_parser.detect_decor = args.decor
+    work_dir = use_headless()
+    expected = load_expected(args.expected)
+    report, results, mistakes, differences = run_benchmark(paths, args.repeat, expected, work_dir)
+    print_report(report, mistakes, differences)
+
+    if args.label:
+        save_labels(args.expected, expected, results)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = find_regressions(report, json.load(f))
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        print(f"{len(regressions)} regressions against {args.baseline}")
+    else:
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+
+    if len(regressions) > 0:
+        sys.exit(1)
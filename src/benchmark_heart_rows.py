@@ -0,0 +1,70 @@
+#!/bin/python3
+
+# Compare finding heart rows over the whole screenshot against the
+# coarse to fine pyramid search, timing each stage. Exits with an
+# error if the pyramid search finds different rows on any screenshot.
+
+import numpy as np
+
+import argparse
+import glob
+import sys
+import time
+
+import pikmin_image_parser
+import profiler
+
+# Find the heart rows with or without the pyramid, returning the rows
+# and the average time of each stage that ran
+def time_heart_rows(cropped, use_pyramid, repeat):
+    pikmin_image_parser.use_pyramid = use_pyramid
+    profiler.reset()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        heart_y_coord = pikmin_image_parser.get_heart_locations(cropped)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    stages = {stage: stage_elapsed / count for stage, (stage_elapsed, count) in profiler.timings.items()}
+
+    return heart_y_coord, elapsed, stages
+
+def run_benchmark(paths, repeat):
+    mismatches = 0
+    totals = {"full": 0, "pyramid": 0}
+    print(f"{'':32s} {'full':>9s} {'coarse':>9s} {'refine':>9s} {'pyramid':>9s} {'speedup':>7s}")
+    for path in paths:
+        cropped = pikmin_image_parser.crop_image(path)
+        # Load templates before timing
+        pikmin_image_parser.get_heart_locations(cropped)
+
+        expected, full_elapsed, _ = time_heart_rows(cropped, False, repeat)
+        heart_y_coord, pyramid_elapsed, stages = time_heart_rows(cropped, True, repeat)
+        totals["full"] += full_elapsed
+        totals["pyramid"] += pyramid_elapsed
+
+        same = np.array_equal(expected, heart_y_coord)
+        if not same:
+            mismatches += 1
+        print(f"{path.split('/')[-1][:32]:32s} {full_elapsed*1000:7.1f}ms "
+              f"{stages.get('heart rows coarse', 0)*1000:7.1f}ms {stages.get('heart rows refine', 0)*1000:7.1f}ms "
+              f"{pyramid_elapsed*1000:7.1f}ms {full_elapsed/pyramid_elapsed:6.2f}x"
+              + ("" if same else f"  MISMATCH {expected} != {heart_y_coord}"))
+
+    print(f"{'Total':32s} {totals['full']*1000:7.1f}ms {'':9s} {'':9s} {totals['pyramid']*1000:7.1f}ms "
+          f"{totals['full']/totals['pyramid']:6.2f}x")
+    print(f"{mismatches} mismatches")
+
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pyramid heart row search")
+    parser.add_argument("inputs", nargs="*", default=["../screenshots/*.jpg"],
+                        help="screenshot files or glob patterns")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of times to repeat each measurement")
+    args = parser.parse_args()
+
+    paths = sorted(set(path for pattern in args.inputs for path in glob.glob(pattern)))
+    if run_benchmark(paths, args.repeat) > 0:
+        sys.exit(1)
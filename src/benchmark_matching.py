@@ -0,0 +1,92 @@
+#!/bin/python3
+
+# Compare the per-template match_template loop against the shared FFT
+# matching engine on the bundled screenshots. Both the full screenshot
+# heart search and the per-pikmin color/maturity lookups are timed.
+
+import numpy as np
+from skimage.feature import match_template
+from skimage.color import rgb2gray
+
+import argparse
+import glob
+import time
+
+import fft_match
+import pikmin_image_parser
+import template_registry
+
+# Time both matchers on one grayscale image, returning
+# (loop seconds, fft seconds, largest difference in response)
+def time_matchers(image_gray, templates, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        expected = [match_template(image_gray, template) for template in templates]
+    loop_elapsed = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = fft_match.match_templates(image_gray, templates)
+    fft_elapsed = (time.perf_counter() - start) / repeat
+
+    max_diff = max(np.abs(a - b).max() for a, b in zip(expected, results))
+
+    return loop_elapsed, fft_elapsed, max_diff
+
+# Flatten a template dictionary into a list
+def template_list(templates):
+    flat = []
+    for val in templates.values():
+        if isinstance(val, list):
+            flat.extend(val)
+        else:
+            flat.append(val)
+
+    return flat
+
+def print_row(name, loop_elapsed, fft_elapsed, max_diff):
+    print(f"{name:40s} {loop_elapsed*1000:9.1f}ms {fft_elapsed*1000:9.1f}ms {loop_elapsed/fft_elapsed:6.2f}x  {max_diff:.1e}")
+
+def run_benchmark(paths, repeat):
+    heart_templates = template_list(template_registry.get_templates("heart"))
+    color_templates = template_list(template_registry.get_templates("color"))
+    maturity_templates = template_list(template_registry.get_templates("maturity"))
+
+    print(f"{'':40s} {'loop':>11s} {'fft':>11s} {'speedup':>7s}  max diff")
+    totals = {"hearts": [0, 0], "color": [0, 0], "maturity": [0, 0]}
+    for path in paths:
+        cropped = pikmin_image_parser.crop_image(path)
+        cropped_gray = rgb2gray(cropped)
+
+        # Heart search over the full screenshot
+        loop_elapsed, fft_elapsed, max_diff = time_matchers(cropped_gray, heart_templates, repeat)
+        print_row(path.split("/")[-1] + " hearts", loop_elapsed, fft_elapsed, max_diff)
+        totals["hearts"][0] += loop_elapsed
+        totals["hearts"][1] += fft_elapsed
+
+        # Color and maturity lookups for every pikmin
+        heart_y_coord = pikmin_image_parser.get_heart_locations(cropped)
+        for pikmin_image in pikmin_image_parser.partition_image(cropped, heart_y_coord):
+            pikmin_gray = rgb2gray(pikmin_image)
+            loop_elapsed, fft_elapsed, _ = time_matchers(pikmin_gray, color_templates, repeat)
+            totals["color"][0] += loop_elapsed
+            totals["color"][1] += fft_elapsed
+            loop_elapsed, fft_elapsed, _ = time_matchers(pikmin_gray[0:100], maturity_templates, repeat)
+            totals["maturity"][0] += loop_elapsed
+            totals["maturity"][1] += fft_elapsed
+
+    print()
+    for name, (loop_elapsed, fft_elapsed) in totals.items():
+        print_row("Total " + name, loop_elapsed, fft_elapsed, 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark template matching")
+    parser.add_argument("inputs", nargs="*", default=["../screenshots/*.jpg"],
+                        help="screenshot files or glob patterns")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of times to repeat each measurement")
+    args = parser.parse_args()
+
+    paths = sorted(set(path for pattern in args.inputs for path in glob.glob(pattern)))
+    run_benchmark(paths, args.repeat)
@@ -0,0 +1,74 @@
+#!/bin/python3
+
+# Measure how long a fresh process takes to import the scanner and
+# identify one screenshot, like a single screenshot CLI call or a new
+# pool worker. Each run starts a new interpreter, once importing only
+# what the scanner needs and once also importing the GUI and numeric
+# modules it used to load at start, to show what deferring them saves.
+
+import numpy as np
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# Modules the scanner only imports once they are needed
+deferred_modules = ["matplotlib.pyplot", "matplotlib.widgets", "scipy.stats", "skimage.feature", "skimage.transform"]
+
+# Run in the fresh interpreter, printing the timings as JSON
+startup_code = """
+import json, sys, time
+start = time.perf_counter()
+for name in {eager}:
+    __import__(name)
+import benchmark
+imported = time.perf_counter()
+if {path!r}:
+    benchmark.use_headless()
+    benchmark.identify_quietly({path!r})
+done = time.perf_counter()
+print(json.dumps({{"import": imported - start, "identify": done - imported,
+                  "loaded": [name for name in {deferred} if name in sys.modules]}}))
+"""
+
+# Start a new interpreter and time it, returning the timings of each part
+def time_startup(path, eager):
+    code = startup_code.format(eager=deferred_modules if eager else [], path=path, deferred=deferred_modules)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    elapsed = time.perf_counter() - start
+
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings["total"] = elapsed
+
+    return timings
+
+def run_benchmark(path, repeat):
+    results = {}
+    for name, eager in [("eager", True), ("lazy", False)]:
+        runs = [time_startup(path, eager) for _ in range(repeat)]
+        results[name] = {part: float(np.median([run[part] for run in runs])) for part in ["import", "identify", "total"]}
+        results[name]["loaded"] = runs[-1]["loaded"]
+
+    return results
+
+def print_results(results):
+    print(f"{'':8s} {'import':>9s} {'identify':>9s} {'total':>9s}")
+    for name, result in results.items():
+        print(f"{name:8s} " + " ".join(f"{result[part]*1000:7.0f}ms" for part in ["import", "identify", "total"]))
+    saved = results["eager"]["total"] - results["lazy"]["total"]
+    print(f"Deferred imports save {saved*1000:.0f}ms ({saved / results['eager']['total']:.0%}) per start")
+    print(f"Loaded when needed: {', '.join(results['lazy']['loaded']) or 'none'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time starting the scanner and identifying one screenshot")
+    parser.add_argument("screenshot", nargs="?", default="../screenshots/white_not_full.jpg",
+                        help="screenshot to identify, or an empty string to only time the import")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="number of fresh processes to start for each import path")
+    args = parser.parse_args()
+
+    print_results(run_benchmark(args.screenshot, args.repeat))
@@ -0,0 +1,71 @@
+#!/bin/python3
+
+# Check that matching only inside each attribute region gives the same
+# answers as matching over the whole pikmin image, and how much faster
+# it is. Exits with an error if any pikmin is classified differently.
+
+import argparse
+import glob
+import time
+
+import pikmin_image_parser
+
+# Detectors that use an attribute region. Hearts are not checked, the
+# heart strip is only searched for inside the heart band either way
+region_detectors = {
+    "color": pikmin_image_parser.match_color,
+}
+
+# Run every detector on every pikmin, returning the results
+# and total time spent in each detector
+def run_detectors(pikmin_images):
+    results = {name: [] for name in region_detectors}
+    elapsed = {name: 0 for name in region_detectors}
+    for pikmin_image in pikmin_images:
+        for name, detector in region_detectors.items():
+            start = time.perf_counter()
+            results[name].append(detector(pikmin_image))
+            elapsed[name] += time.perf_counter() - start
+
+    return results, elapsed
+
+def check_regions(paths):
+    mismatches = 0
+    total_full = {name: 0 for name in region_detectors}
+    total_region = {name: 0 for name in region_detectors}
+    for path in paths:
+        cropped = pikmin_image_parser.crop_image(path)
+        heart_y_coord = pikmin_image_parser.get_heart_locations(cropped)
+        pikmin_images = pikmin_image_parser.partition_image(cropped, heart_y_coord)
+
+        pikmin_image_parser.use_regions = False
+        full_results, full_elapsed = run_detectors(pikmin_images)
+        pikmin_image_parser.use_regions = True
+        region_results, region_elapsed = run_detectors(pikmin_images)
+
+        for name in region_detectors:
+            total_full[name] += full_elapsed[name]
+            total_region[name] += region_elapsed[name]
+            for i, (expected, actual) in enumerate(zip(full_results[name], region_results[name])):
+                if expected != actual:
+                    print(f"MISMATCH {path} pikmin {i} {name}: full image {expected}, region {actual}")
+                    mismatches += 1
+
+    print()
+    for name in region_detectors:
+        print(f"{name:8s} full image {total_full[name]:6.2f}s  region {total_region[name]:6.2f}s  "
+              f"({total_full[name]/total_region[name]:.2f}x)")
+    print(f"{mismatches} mismatches")
+
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check region matching against full image matching")
+    parser.add_argument("inputs", nargs="*", default=["../screenshots/*.jpg"],
+                        help="screenshot files or glob patterns")
+    args = parser.parse_args()
+
+    paths = sorted(set(path for pattern in args.inputs for path in glob.glob(pattern)))
+    if check_regions(paths) > 0:
+        exit(1)
@@ -0,0 +1,157 @@
+#!/bin/python3
+
+# Index of the name bands of renamed pikmin, used to find their color.
+# Every custom color template is reduced to a small fixed size feature
+# vector with zero mean and unit length, so the normalized correlation
+# with all of them is a single matrix multiplication instead of a
+# template match per custom template.
+#
+# The index is saved next to the custom templates and only the
+# templates that were added to the template atlas since it was saved
+# are converted.
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import os
+
+import template_atlas
+
+index_path = "../templates/custom/color_index.npz"
+
+# Where prompt_user_color cuts the name band from a pikmin image,
+# (top, bottom, left, right) on the reference screen
+name_band = (190, 220, 20, 140)
+# Size the name band is reduced to, half of the reference size
+feature_shape = (15, 60)
+# Feature pixels the name band may be shifted by in each direction
+shift_search = 2
+# Lowest correlation that counts as the same name
+threshold = 0.9
+
+# Loaded index, shared by every lookup in the process
+_index = None
+
+# Turn grayscale name bands of feature_shape, in the last two axes,
+# into unit length vectors with zero mean
+def _normalize(bands):
+    vectors = bands.reshape(bands.shape[:-2] + (-1,))
+    vectors = vectors - vectors.mean(axis=-1, keepdims=True)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    # Flat bands cannot match anything
+    norms[norms == 0] = np.inf
+
+    return (vectors / norms).astype(np.float32)
+
+# Feature vector of a grayscale custom template
+def template_feature(template):
+    # skimage.transform is slow to import, so only load it once needed
+    from skimage.transform import resize
+
+    return _normalize(resize(template, feature_shape, anti_aliasing=True))
+
+class ColorIndex:
+    def __init__(self, names=None, offsets=None, labels=None, features=None):
+        # Name and offset in the template atlas of each template
+        self.names = list(names) if names is not None else []
+        self.offsets = list(offsets) if offsets is not None else []
+        self.labels = list(labels) if labels is not None else []
+        self.features = features if features is not None else np.zeros((0, np.prod(feature_shape)), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.labels)
+
+    # Find the color of each pikmin in a stack of grayscale pikmin images
+    # of the same size, with None where no renamed pikmin matches
+    def lookup(self, images_gray, screen_scale=1):
+        count = len(images_gray)
+        if len(self) == 0 or count == 0:
+            return [None] * count
+        from skimage.transform import resize
+
+        # Cut the name band with room for the shifts around it,
+        # in reference pixels
+        margin = shift_search * (name_band[1] - name_band[0]) // feature_shape[0]
+        top, bottom, left, right = [round(side * screen_scale) for side in
+                                    [name_band[0]-margin, name_band[1]+margin, name_band[2]-margin, name_band[3]+margin]]
+        height, width = images_gray.shape[1:3]
+        if top < 0 or left < 0 or bottom > height or right > width:
+            return [None] * count
+        bands = resize(images_gray[:, top:bottom, left:right],
+                       (count, feature_shape[0] + 2*shift_search, feature_shape[1] + 2*shift_search),
+                       anti_aliasing=True)
+
+        # Every shift of every pikmin against every custom template at once
+        shifted = sliding_window_view(bands, feature_shape, axis=(1, 2))
+        scores = _normalize(shifted).reshape(count, -1, self.features.shape[1]) @ self.features.T
+        scores = scores.max(axis=1)
+
+        best = np.argmax(scores, axis=1)
+        return [self.labels[best[i]] if scores[i, best[i]] > threshold else None for i in range(count)]
+
+    # Several worker processes may save at once, so each writes its
+    # own file and moves it into place
+    def save(self, path):
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, names=np.array(self.names, dtype=str), offsets=np.array(self.offsets, dtype=np.int64),
+                     labels=np.array(self.labels, dtype=str), features=self.features,
+                     feature_shape=np.array(feature_shape))
+        os.replace(temp_path, path)
+
+# Load the saved index, if it was made with the same feature size
+def _load_saved(path):
+    if not os.path.exists(path):
+        return ColorIndex()
+
+    with np.load(path) as saved:
+        # Indexes of template files from before the atlas are rebuilt
+        if "names" not in saved or tuple(saved["feature_shape"]) != feature_shape:
+            return ColorIndex()
+        return ColorIndex(saved["names"], saved["offsets"], saved["labels"], saved["features"])
+
+# Bring the saved index up to date with the custom color templates,
+# only converting templates that are new
+def build():
+    saved = _load_saved(index_path)
+    saved_rows = {name: (offset, row) for row, (name, offset) in enumerate(zip(saved.names, saved.offsets))}
+
+    atlas = template_atlas.get_atlas()
+    index = ColorIndex()
+    features = []
+    changed = False
+    for entry in atlas.entries:
+        if entry["attribute"] != "color":
+            continue
+        name = entry["name"]
+        if name in saved_rows and saved_rows[name][0] == entry["offset"]:
+            feature = saved.features[saved_rows[name][1]]
+        else:
+            feature = template_feature(atlas.template(entry))
+            changed = True
+        index.names.append(name)
+        index.offsets.append(entry["offset"])
+        index.labels.append(entry["label"])
+        features.append(feature)
+    if len(features) > 0:
+        index.features = np.stack(features)
+
+    # Also save when templates were removed
+    if changed or len(index) != len(saved):
+        index.save(index_path)
+        print(f"Color index updated, {len(index)} renamed pikmin")
+
+    return index
+
+# Get the index, building it the first time it is needed
+def get_index():
+    global _index
+    if _index is None:
+        _index = build()
+
+    return _index
+
+# Rebuild the index next time it is used, after a custom template was added
+def invalidate():
+    global _index
+    _index = None
@@ -0,0 +1,169 @@
+#!/bin/python3
+
+# Remove pikmin that show up in more than one screenshot of the same
+# challenge. Each pikmin gets a 255 bit perceptual hash of its figure
+# and name, and hashes are kept in a BK-tree per challenge so near
+# duplicates are found without comparing against every pikmin seen so
+# far.
+#
+# Pikmin that look exactly the same (same default name, maturity and
+# hearts) cannot be told apart from a duplicate, so only pikmin from a
+# different screenshot that were also classified the same are treated
+# as duplicates. Fields that were not read never agree.
+
+import numpy as np
+
+import os
+import time
+
+import profiler
+
+# Part of the pikmin image that is hashed, ((top, bottom), (left, right))
+# as fractions of its size. The figure and name band, leaving out the
+# heart strip and the selection border, which many pikmin share
+hash_region = ((0.05, 0.83), (0.10, 0.90))
+# Blocks the region is shrunk to before the DCT
+hash_blocks = 32
+# Lowest DCT frequencies kept in each direction. The first one, the
+# average brightness, is left out, so the hash has hash_size**2 - 1 bits
+hash_size = 16
+# Integer luma weights, so the image never has to be converted to float
+luma_weights = np.array([299, 587, 114], dtype=np.uint32)
+# DCT-II basis of the block image
+_dct = np.cos(np.pi * np.arange(hash_size)[:, np.newaxis] * (2*np.arange(hash_blocks) + 1) / (2*hash_blocks))
+
+# Perceptual hash: shrink the region to 32x32 by averaging blocks of
+# pixels, take the 16x16 lowest frequencies of its DCT and store whether
+# each is above their median. Low frequencies hardly change with JPEG
+# noise or a crop that is a few pixels off, unlike the brightness of
+# neighbouring blocks of flat background. The blocks are summed straight
+# from the uint8 image and only the block sums are turned into brightness
+def perceptual_hash(pikmin_image):
+    height, width = pikmin_image.shape[:2]
+    (top, bottom), (left, right) = hash_region
+    y = np.linspace(int(top*height), int(bottom*height), hash_blocks + 1).round().astype(int)
+    x = np.linspace(int(left*width), int(right*width), hash_blocks + 1).round().astype(int)
+    sums = np.add.reduceat(pikmin_image[y[0]:y[-1], x[0]:x[-1], :3], y[:-1] - y[0], axis=0, dtype=np.uint32)
+    sums = np.add.reduceat(sums, x[:-1] - x[0], axis=1)
+    small = (sums @ luma_weights) / np.outer(np.diff(y), np.diff(x))
+    frequencies = (_dct @ small @ _dct.T).flatten()[1:]
+    bits = frequencies > np.median(frequencies)
+
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+# Hash as stored in the records, two hex digits for every byte
+# np.packbits made
+def format_hash(phash):
+    return format(phash, f"0{2 * ((hash_size**2 - 1 + 7) // 8)}x")
+
+# Number of bits that differ between two hashes
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+# Tree of hashes where each child is stored under its distance from
+# the parent, which lets searches skip branches that are too far away
+class BKTree:
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = (key, value, {})
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(key, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (key, value, {})
+                return
+            node = child
+
+    # Get (distance, value) of every key within max_distance
+    def find(self, key, max_distance):
+        found = []
+        if self.root is None:
+            return found
+
+        candidates = [self.root]
+        while candidates:
+            node_key, node_value, children = candidates.pop()
+            distance = hamming_distance(key, node_key)
+            if distance <= max_distance:
+                found.append((distance, node_value))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    candidates.append(child)
+
+        return found
+
+# Fields that have to agree for two pikmin to be duplicates
+compared_fields = ["color", "maturity", "hearts", "selected", "decor"]
+# Field values of pikmin that were not read, which never agree
+unknown_values = [None, "unknown"]
+
+# Name of the challenge a screenshot belongs to, for each way of
+# grouping screenshots into challenges. Stitched groups are named after
+# their screenshots joined with "+", see stitch.group_name
+challenge_groupings = {
+    # The screenshots of each challenge are kept in a directory of their own
+    "directory": lambda name: os.path.dirname(os.path.abspath(name.split("+")[0])),
+    # Every screenshot of the run is from one challenge
+    "batch": lambda name: "",
+}
+
+# Keeps the hashes of every pikmin seen so far in each challenge
+class Deduplicator:
+    def __init__(self, max_distance=8, grouping="directory"):
+        self.max_distance = max_distance
+        self.challenge_of = challenge_groupings[grouping]
+        # {challenge: BKTree}
+        self.indexes = {}
+        self.stats = {
+            "pikmin": 0,
+            "duplicates": 0,
+            "unique": 0,
+        }
+        self.seconds = 0
+        profiler.register_counters("dedup", self.stats, {"dedup": ("duplicates", "unique")})
+
+    # Return the records that have not been seen in an earlier
+    # screenshot of the same challenge, and add them to its index
+    def filter(self, pikmin_records):
+        start = time.perf_counter()
+
+        kept = []
+        for record in pikmin_records:
+            self.stats["pikmin"] += 1
+            attributes = tuple(record[field] for field in compared_fields)
+            index = self.indexes.setdefault(self.challenge_of(record["file"]), BKTree())
+            if not any(value in unknown_values for value in attributes):
+                matches = index.find(int(record["phash"], 16), self.max_distance)
+                if any(file != record["file"] and match_attributes == attributes
+                       for _, (file, match_attributes) in matches):
+                    self.stats["duplicates"] += 1
+                    continue
+
+            self.stats["unique"] += 1
+            kept.append(record)
+        # Added afterwards so pikmin in the same screenshot never match each other
+        for record in kept:
+            attributes = tuple(record[field] for field in compared_fields)
+            index = self.indexes[self.challenge_of(record["file"])]
+            index.add(int(record["phash"], 16), (record["file"], attributes))
+
+        elapsed = time.perf_counter() - start
+        self.seconds += elapsed
+        profiler.add_time("dedup", elapsed)
+
+        return kept
+
+    def print_stats(self):
+        hit_rate = self.stats["duplicates"] / self.stats["pikmin"] if self.stats["pikmin"] > 0 else 0
+        index_size = sum(index.size for index in self.indexes.values())
+        print(f"Duplicates removed: {self.stats['duplicates']} of {self.stats['pikmin']} pikmin "
+              f"({hit_rate:.0%}) in {self.seconds*1000:.1f}ms, {index_size} in the index of "
+              f"{len(self.indexes)} challenges")
@@ -0,0 +1,222 @@
+#!/bin/python3
+
+# Normalized cross correlation template matching that gives the same
+# result as skimage.feature.match_template, but computes the FFT of the
+# image once and reuses it for every template. Local sums of the image
+# are also shared between templates of the same size.
+#
+# A stack of images of the same size, shaped (count, height, width),
+# can be matched at once, giving a stack of response maps.
+#
+# float32 images are matched in single precision, which halves the
+# memory of every array and speeds up the FFTs. The image and template
+# are centered before the FFT so the cross correlation keeps enough
+# precision, and the local sums are still added up in double precision.
+# The responses agree with match_template to about 1e-5 instead of exactly.
+#
+# Reference: J. P. Lewis, "Fast Normalized Cross-Correlation"
+
+import numpy as np
+from scipy import fft
+
+from collections import OrderedDict
+
+# FFTs of templates, keyed by (id of template, FFT shape, precision). The
+# template itself is stored with the FFT so a reused id is never mistaken for a match
+_template_fft_cache = OrderedDict()
+# Most template FFTs to keep, the least recently used are dropped first.
+# Scanning the bundled screenshots at two screen sizes uses about 64
+template_fft_cache_size = 128
+
+# Windows of a single precision image whose variance per pixel is below
+# this are flat. Any real detail in an 8 bit image is far above it
+flat_variance = 1e-8
+
+# Running sum down the columns of the image, with a row of zeros on top.
+# It does not depend on the window size so it is shared by every template
+def _column_cumsum(image):
+    column_cumsum = np.cumsum(image, axis=-2)
+    zeros = np.zeros(column_cumsum.shape[:-2] + (1, column_cumsum.shape[-1]))
+
+    return np.concatenate([zeros, column_cumsum], axis=-2)
+
+# Sum of the image inside every window of the given size, computed
+# the same way as match_template so the results agree exactly
+def _window_sum(column_cumsum, window_shape):
+    window_h, window_w = window_shape
+
+    row_sums = column_cumsum[..., window_h:, :] - column_cumsum[..., :-window_h, :]
+
+    # Running sum along the rows, written after a column of zeros
+    row_cumsum = np.zeros(row_sums.shape[:-1] + (row_sums.shape[-1] + 1,))
+    np.cumsum(row_sums, axis=-1, out=row_cumsum[..., 1:])
+    del row_sums
+
+    return row_cumsum[..., window_w:] - row_cumsum[..., :-window_w]
+
+# Get the FFT of a flipped template, padded to the FFT shape.
+# In single precision the template is centered first
+def _template_fft(template, fft_shape, dtype=np.float64):
+    key = (id(template), fft_shape, np.dtype(dtype).name)
+    cached = _template_fft_cache.get(key)
+    if cached is not None and cached[0] is template:
+        _template_fft_cache.move_to_end(key)
+        return cached[1]
+
+    if dtype == np.float32:
+        flipped = (template - template.mean())[::-1, ::-1].astype(np.float32)
+    else:
+        flipped = template[::-1, ::-1]
+    template_fft = fft.rfft2(flipped, fft_shape)
+    _template_fft_cache[key] = (template, template_fft)
+    _template_fft_cache.move_to_end(key)
+    while len(_template_fft_cache) > template_fft_cache_size:
+        _template_fft_cache.popitem(last=False)
+
+    return template_fft
+
+# Precompute everything about a grayscale image that does not depend on
+# the template. max_template_shape is the largest template that will be
+# matched, which sets how far the FFT needs to be padded
+def prepare_image(image, max_template_shape):
+    image = np.asarray(image)
+    if image.dtype != np.float32:
+        image = image.astype(np.float64, copy=False)
+    image_h, image_w = image.shape[-2:]
+    fft_shape = (fft.next_fast_len(image_h + max_template_shape[0] - 1, real=True),
+                 fft.next_fast_len(image_w + max_template_shape[1] - 1, real=True))
+
+    if image.dtype == np.float32:
+        image_fft = fft.rfft2(image - image.mean(axis=(-2, -1), keepdims=True), fft_shape)
+    else:
+        image_fft = fft.rfft2(image, fft_shape)
+
+    return {
+        "image": image,
+        "fft_shape": fft_shape,
+        "fft": image_fft,
+        # Local sums for each template size, filled in as needed
+        "column_cumsums": None,
+        "window_sums": {},
+    }
+
+# Keep only some images of a prepared stack, so templates
+# are not matched against images that are already resolved
+def select_prepared(prepared, indices):
+    return {
+        "image": prepared["image"][indices],
+        "fft_shape": prepared["fft_shape"],
+        "fft": prepared["fft"][indices],
+        "column_cumsums": None if prepared["column_cumsums"] is None else
+            tuple(column_cumsum[indices] for column_cumsum in prepared["column_cumsums"]),
+        "window_sums": {shape: (window_sum[indices], image_ssd[indices])
+                        for shape, (window_sum, image_ssd) in prepared["window_sums"].items()},
+    }
+
+# Get sum and sum of squares of the image for every window
+# of a template size, reusing them between templates of the same size
+def _window_stats(prepared, window_shape):
+    if window_shape not in prepared["window_sums"]:
+        if prepared["column_cumsums"] is None:
+            image = prepared["image"].astype(np.float64, copy=False)
+            prepared["column_cumsums"] = (_column_cumsum(image), _column_cumsum(image ** 2))
+        column_cumsum, column_cumsum2 = prepared["column_cumsums"]
+        window_sum = _window_sum(column_cumsum, window_shape)
+        window_sum2 = _window_sum(column_cumsum2, window_shape)
+        # Variance term of the denominator only depends on the image
+        window_volume = window_shape[0] * window_shape[1]
+        image_ssd = window_sum * window_sum
+        image_ssd /= window_volume
+        np.subtract(window_sum2, image_ssd, out=image_ssd)
+        dtype = prepared["image"].dtype
+        prepared["window_sums"][window_shape] = (window_sum.astype(dtype, copy=False),
+                                                 image_ssd.astype(dtype, copy=False))
+
+    return prepared["window_sums"][window_shape]
+
+# Match one template against a prepared image. Returns the same
+# response map as match_template(image, template)
+def match_prepared(prepared, template):
+    image_h, image_w = prepared["image"].shape[-2:]
+    template_h, template_w = template.shape
+    if template_h > image_h or template_w > image_w:
+        raise ValueError("Image must be larger than template.")
+    fft_shape = prepared["fft_shape"]
+    if template_h + image_h - 1 > fft_shape[0] or template_w + image_w - 1 > fft_shape[1]:
+        raise ValueError("Template is larger than the image was prepared for.")
+
+    # Cross correlation, keeping only positions where the template
+    # fits completely inside the image
+    dtype = prepared["image"].dtype
+    product = prepared["fft"] * _template_fft(template, fft_shape, dtype)
+    xcorr = fft.irfft2(product, fft_shape)[..., template_h-1:image_h, template_w-1:image_w]
+
+    window_sum, image_ssd = _window_stats(prepared, template.shape)
+
+    template_mean = template.mean()
+    template_ssd = np.sum((template - template_mean) ** 2)
+
+    if dtype == np.float32:
+        # The template was centered, which already removes the mean
+        numerator = xcorr
+    else:
+        numerator = xcorr - window_sum * template_mean
+    denominator = np.sqrt(np.maximum(image_ssd * template_ssd, 0))
+
+    # Avoid dividing by zero in flat areas
+    response = np.zeros_like(xcorr)
+    if dtype == np.float32:
+        mask = (image_ssd > flat_variance * template_h * template_w) & (template_ssd > 0)
+    else:
+        mask = denominator > np.finfo(np.float64).eps
+    response[mask] = numerator[mask] / denominator[mask]
+
+    return response
+
+# Largest height and width out of a list of templates
+def max_template_shape(templates):
+    return (max(template.shape[0] for template in templates),
+            max(template.shape[1] for template in templates))
+
+# Match every template against an image, returning
+# a response map for each template in order
+def match_templates(image, templates):
+    prepared = prepare_image(image, max_template_shape(templates))
+
+    return [match_prepared(prepared, template) for template in templates]
+
+# Mark the peaks in a response map, or a stack of them, the same way
+# as peak_local_max(response, threshold_abs=threshold,
+# exclude_border=exclude_border) with min_distance=1
+def peak_mask(responses, threshold, exclude_border):
+    height, width = responses.shape[-2:]
+    mask = responses > threshold
+    if exclude_border > 0:
+        mask[..., :exclude_border, :] = False
+        mask[..., -exclude_border:, :] = False
+        mask[..., :, :exclude_border] = False
+        mask[..., :, -exclude_border:] = False
+    if height * width == 1:
+        return mask
+
+    # Very few positions pass the threshold, so only those are compared
+    # with their 3x3 neighbourhood, repeating edge values like the
+    # maximum filter used by peak_local_max
+    candidates = np.nonzero(mask)
+    stack_index, y, x = candidates[:-2], candidates[-2], candidates[-1]
+    values = responses[candidates]
+    is_peak = np.ones(len(values), dtype=bool)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            neighbour_y = np.clip(y + dy, 0, height-1)
+            neighbour_x = np.clip(x + dx, 0, width-1)
+            is_peak &= values >= responses[stack_index + (neighbour_y, neighbour_x)]
+
+    # A map with no variation has no peaks
+    if len(values) > 0:
+        maps = responses.reshape((-1, height*width))
+        is_constant = (maps.max(axis=1) == maps.min(axis=1)).reshape(responses.shape[:-2])
+        is_peak &= ~is_constant[stack_index]
+    mask[candidates] = is_peak
+
+    return mask
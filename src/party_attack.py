@@ -0,0 +1,261 @@
+#!/bin/python3
+
+# Rank the parties that can be sent to a challenge by their attack.
+# Every pikmin gets an attack from its color, maturity, friendship
+# hearts and decor, computed for the whole roster at once. Attacks add
+# up, so the best party is simply the strongest pikmin, and the next
+# best parties are found by a best-first search over how many pikmin
+# are taken from each attack level instead of trying every combination.
+#
+# The roster is read from a file written by batch_scan.py -o, or
+# scanned from screenshots.
+#
+# The game does not publish its attack modifiers, so the values below
+# are placeholders and every result made with them says so. Real values
+# can be given with --modifiers FILE, a JSON object with any of the keys
+# of modifiers, e.g. {"heart_attack": 2, "decor_bonus": 1.1}.
+
+import numpy as np
+
+import argparse
+import csv
+import heapq
+import json
+import os
+
+# Placeholder attack modifiers, until replaced by load_modifiers
+modifiers = {
+    # Attack of a pikmin before any modifier
+    "base_attack": 10,
+    # Attack added for each friendship heart icon
+    "heart_attack": 2.5,
+    # Multipliers for the maturity of the flower or leaf
+    "maturity_modifiers": {
+        "bare": 1.0,
+        "leaf": 1.0,
+        "bud": 1.2,
+        "normal": 1.5,
+        "rare": 1.5,
+    },
+    # Multiplier for pikmin of a color the challenge favours
+    "color_bonus": 1.5,
+    # Multiplier for pikmin wearing decor
+    "decor_bonus": 1.2,
+}
+# Modifiers that still have their placeholder value
+placeholders = set(modifiers)
+# Fields that could not be read count as the weakest value, so a
+# party is never rated higher than it really is
+unknown_values = ("unknown", "", None)
+
+# Replace modifiers with the ones in a JSON file. Maturities missing
+# from the file keep their placeholder multiplier
+def load_modifiers(path):
+    with open(path) as f:
+        loaded = json.load(f)
+    unknown = set(loaded) - set(modifiers)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown attack modifiers in {path}: {', '.join(sorted(unknown))}")
+
+    if "maturity_modifiers" in loaded:
+        loaded["maturity_modifiers"] = {**modifiers["maturity_modifiers"], **loaded["maturity_modifiers"]}
+    modifiers.update(loaded)
+    placeholders.difference_update(loaded)
+
+# Turn a column of field values into modifiers with a lookup table,
+# converting each distinct value only once
+def lookup(values, table, default):
+    distinct, inverse = np.unique(np.array([str(value) for value in values]), return_inverse=True)
+    modifiers = np.array([table.get(value, default) for value in distinct], dtype=float)
+
+    return modifiers[inverse]
+
+# Attack of every pikmin in a list of records
+def pikmin_attack(records, bonus_colors=()):
+    if len(records) == 0:
+        return np.zeros(0)
+
+    hearts = np.array([record["hearts"] if record["hearts"] not in unknown_values else 0
+                       for record in records], dtype=float)
+    attack = modifiers["base_attack"] + modifiers["heart_attack"] * hearts
+    maturity_modifiers = modifiers["maturity_modifiers"]
+    attack *= lookup([record["maturity"] for record in records], maturity_modifiers,
+                     min(maturity_modifiers.values()))
+    attack *= lookup([record["color"] for record in records],
+                     {color: modifiers["color_bonus"] for color in bonus_colors}, 1.0)
+    attack *= lookup([record.get("decor") for record in records], {"yes": modifiers["decor_bonus"]}, 1.0)
+
+    return attack
+
+# Indices of the strongest party of the given size, strongest first
+def best_party(attack, size):
+    size = min(size, len(attack))
+    if size == 0:
+        return np.zeros(0, dtype=int)
+    strongest = np.argpartition(-attack, size-1)[0:size]
+
+    return strongest[np.argsort(-attack[strongest], kind="stable")]
+
+# The top_k parties of the given size with the highest total attack,
+# as (total attack, indices) with the best party first. Pikmin with the
+# same attack are interchangeable, so parties that only swap them count
+# as the same party.
+#
+# A party is stored as how many pikmin it takes from each attack level.
+# Moving one pikmin down to the next weaker level never makes a party
+# stronger, and every party can be reached from the strongest one by
+# such moves, so taking parties from a heap in order of attack gives
+# the best ones first without looking at most of the combinations
+def top_parties(attack, size, top_k):
+    size = min(size, len(attack))
+    order = np.argsort(-attack, kind="stable")
+    negative_levels, starts, counts = np.unique(-attack[order], return_index=True, return_counts=True)
+    levels = -negative_levels
+
+    # Strongest party takes from the strongest levels first
+    first = []
+    left = size
+    for count in counts:
+        first.append(int(min(count, left)))
+        left -= first[-1]
+    first = tuple(first)
+
+    heap = [(-float(np.dot(levels, first)), first)]
+    seen = {first}
+    parties = []
+    while heap and len(parties) < top_k:
+        negative_total, taken = heapq.heappop(heap)
+        indices = np.concatenate([order[start:start+count] for start, count in zip(starts, taken)])
+        parties.append((-negative_total, indices))
+
+        for level in range(len(levels) - 1):
+            if taken[level] == 0 or taken[level+1] == counts[level+1]:
+                continue
+            successor = taken[0:level] + (taken[level] - 1, taken[level+1] + 1) + taken[level+2:]
+            if successor in seen:
+                continue
+            seen.add(successor)
+            heapq.heappush(heap, (-float(np.dot(levels, successor)), successor))
+
+    return parties
+
+# Compare the pikmin that were selected for the challenge with the best
+# party of the same size. Returns a summary with the pikmin that should
+# have been sent instead
+def compare_selected(records, attack, size=None):
+    selected = np.flatnonzero([bool(record["selected"]) for record in records])
+    if size is None:
+        size = len(selected) if len(selected) > 0 else len(records)
+    best = best_party(attack, size)
+
+    selected_total = attack[selected].sum()
+    best_total = attack[best].sum()
+    selected_set = set(selected)
+    best_set = set(best)
+
+    return {
+        "size": int(size),
+        "selected": len(selected),
+        "selected_attack": float(selected_total),
+        "best_attack": float(best_total),
+        "efficiency": float(selected_total / best_total) if best_total > 0 else 1.0,
+        "add": [int(i) for i in best if i not in selected_set],
+        "remove": [int(i) for i in selected if i not in best_set],
+    }
+
+# Short description of a pikmin for printing
+def describe(record, attack):
+    decor = " with decor" if record.get("decor") == "yes" else ""
+    return (f"{record['color']} {record['maturity']}{decor}, {record['hearts']} hearts "
+            f"({attack:.1f} attack, {os.path.basename(str(record['file']))} #{record['index']})")
+
+# Read records written by batch_scan.py, converting the CSV columns back
+def load_records(path):
+    records = []
+    with open(path, newline="") as f:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(f):
+                row["index"] = int(row["index"])
+                row["hearts"] = int(row["hearts"]) if row["hearts"] not in unknown_values else None
+                row["selected"] = row["selected"] == "True"
+                records.append(row)
+        else:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+
+    return records
+
+# Group records into the roster of each challenge, one per screenshot
+# unless every record belongs to the same challenge
+def group_rosters(records, combined=False):
+    if combined:
+        return {"all screenshots": records}
+
+    rosters = {}
+    for record in records:
+        rosters.setdefault(record["file"], []).append(record)
+
+    return rosters
+
+def print_roster(name, records, size, top_k, bonus_colors):
+    attack = pikmin_attack(records, bonus_colors)
+    comparison = compare_selected(records, attack, size)
+
+    print(f"{name}: {len(records)} pikmin, party of {comparison['size']}")
+    for rank, (total, party) in enumerate(top_parties(attack, comparison["size"], top_k)):
+        print(f"  #{rank+1} party attack {total:.1f}")
+    if comparison["selected"] > 0:
+        print(f"  Selected party attack {comparison['selected_attack']:.1f} "
+              f"({comparison['efficiency']:.0%} of the best party of {comparison['size']})")
+        for i in comparison["remove"]:
+            print(f"    Leave out {describe(records[i], attack[i])}")
+        for i in comparison["add"]:
+            print(f"    Send      {describe(records[i], attack[i])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rank the parties that can be sent to a challenge by attack")
+    parser.add_argument("inputs", nargs="+",
+                        help="results written by batch_scan.py (.csv or .jsonl), or screenshots to scan")
+    parser.add_argument("-n", "--size", type=int, default=None,
+                        help="pikmin per party (default: as many as were selected)")
+    parser.add_argument("-k", "--top", type=int, default=3,
+                        help="number of parties to list")
+    parser.add_argument("--bonus-color", action="append", default=[],
+                        help="color the challenge favours, can be given more than once")
+    parser.add_argument("--combined", action="store_true",
+                        help="treat every screenshot as part of one challenge")
+    parser.add_argument("--decor", action="store_true",
+                        help="read decor when scanning screenshots, queueing every pikmin no decor template matches")
+    parser.add_argument("--modifiers", metavar="FILE",
+                        help="JSON file with the attack modifiers to use instead of the placeholder values")
+    args = parser.parse_args()
+
+    if args.modifiers is not None:
+        load_modifiers(args.modifiers)
+
+    records = []
+    screenshots = []
+    for item in args.inputs:
+        if item.lower().endswith((".csv", ".jsonl", ".json")):
+            records.extend(load_records(item))
+        else:
+            screenshots.append(item)
+    if len(screenshots) > 0:
+        # Loading the scanner is slow, so results files are read without it
+        import batch_scan
+        scanned = batch_scan.scan_batch(batch_scan.expand_inputs(screenshots), headless=True, decor=args.decor)
+        for path, file_records, _ in scanned:
+            records.extend(file_records)
+
+    if len(placeholders) > 0:
+        print(f"Attack uses placeholder values for {', '.join(sorted(placeholders))}, "
+              f"not the game's. Give real ones with --modifiers FILE")
+    # Decor is only read when asked for, and the bonus is only given to
+    # pikmin known to wear it
+    no_decor = sum(1 for record in records if record.get("decor") in unknown_values)
+    if no_decor > 0:
+        print(f"Decor was not read for {no_decor} of {len(records)} pikmin, they get no decor_bonus")
+    for name, roster in group_rosters(records, args.combined).items():
+        print_roster(name, roster, args.size, args.top, [color.lower() for color in args.bonus_color])
@@ -1,59 +1,396 @@
 #!/bin/python3
 
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.widgets import RectangleSelector, Button, RadioButtons
-
-from skimage.io import imread, imsave
-from skimage.feature import match_template
-from skimage.feature import peak_local_max
+from numpy.lib.stride_tricks import sliding_window_view
+# matplotlib is only imported by the prompts and skimage.feature by the
+# searches that need it, so headless runs and pool workers start quickly
+from skimage.io import imread
 from skimage.color import rgb2gray
 
-from scipy import stats
-
-import csv
 import glob
+import math
+
+import color_index
+import profiler
+import template_ranking
+import template_atlas
+import template_registry
+import review_queue
+import fft_match
+import dedup
+
+# When headless, pikmin that cannot be classified are added to the
+# review queue instead of opening a prompt, so batch runs can finish
+headless = False
+# Value used for fields that are waiting in the review queue
+UNKNOWN = "unknown"
+
+# Where each attribute can appear in a pikmin image, as fractions of
+# the partition (top, bottom) and (left, right). Partitions are sized
+# from the distance between heart rows, so these scale with the screen
+attribute_regions = {
+    # Name band, see prompt_user_color
+    "color": ((0.70, 0.83), (0.10, 0.90)),
+    # Heart icons sit just below the heart row the partition is built around
+    "hearts": ((0.87, 0.94), (0.20, 0.85)),
+    # Decor is worn on the pikmin, above the name band
+    "decor": ((0.05, 0.70), (0.10, 0.90)),
+}
+# Pixels added around each region so features that are slightly
+# off still match. Must be more than the exclude_border used for peaks
+region_margin = 25
+# Match over the whole pikmin image instead of the attribute region
+use_regions = True
+
+# Screen the templates and pixel sizes in this file were made for
+reference_width = 864
+reference_partition_sides = [25, 185, 350, 515, 675, 845]
+# Rows between the header separator line and the top of the pikmin list,
+# and between the bottom of the list and the system bar, at reference_width
+reference_list_top_offset = 124
+reference_list_bottom_offset = 20
+# Crop used if the header or system bar cannot be found, at reference_width
+reference_crop = (410, 1650)
+reference_height = 1776
+# Rows the header separator line and the system bar can be away from
+# where they are on the reference screen, at reference_width. Other
+# uniform rows, like the ones in the header, are further away
+bounds_search = 60
+# Largest difference between the column pitch found in a screenshot
+# and the reference pitch, as a fraction of the reference pitch
+column_pitch_tolerance = 0.05
+# Pixels a heart strip center can be away from the column grid and still
+# count as on it, at reference_width. Strips that missed their last icon
+# are half a heart pitch away
+column_center_tolerance = 2
+# Fewest heart strips on the column grid needed to trust it
+min_column_strips = 3
+# Rows between the heart strips of two pikmin rows, at reference_width
+reference_row_pitch = 264
+# Largest distance of a heart row from the row grid, and of the row
+# pitch found in a screenshot from the reference pitch, as a fraction
+# of the pitch. Heart matches elsewhere, like on pikmin eyes, are further
+row_pitch_tolerance = 0.1
+
+# Record fields that depend on templates learned from prompts, and the
+# template atlas attribute they are learned as. Hearts are read from the
+# built in heart templates, so a learned template cannot change them
+rescan_attributes = {"color": "color", "maturity": "maturity", "decor": "decor"}
+
+# Score at which a maturity wins without trying the remaining templates.
+# The right maturity usually scores 0.92 and up, the others stay below 0.85
+maturity_confidence = 0.92
+# Rows at the top of a pikmin image that show its maturity, on the reference screen
+maturity_rows = 100
+
+# Read whether pikmin wear decor. Decor is only recognised by the decor
+# templates learned so far, and there is no template for a pikmin
+# without decor, so every pikmin that matches none is asked about. With
+# only the built in teacup that is nearly every pikmin, so decor is only
+# read when asked for, and is None in the records otherwise
+detect_decor = False
+# Score at which a decor template counts as a match
+decor_threshold = 0.9
+# Pikmin are first matched on a region downsampled by pyramid_factor,
+# only the ones that score this there are matched at full resolution
+decor_screen_threshold = 0.7
+# Most decor templates tried per pikmin, the ones that won most often
+# first, so learning many decor templates does not slow every screenshot
+decor_max_templates = 20
+
+# Precision of the grayscale images used for template matching. float32
+# halves the memory of every image, FFT and response map. Set to
+# np.float64 to match exactly like skimage.feature.match_template
+gray_dtype = np.float32
+# Weights skimage.color.rgb2gray uses for red, green and blue
+gray_weights = (0.2125, 0.7154, 0.0721)
+
+# Find heart rows on an image downsampled by pyramid_factor first, and
+# only match at full resolution around rows that scored pyramid_threshold.
+# Heart rows score 0.94 and up on the downsampled screenshots
+use_pyramid = True
+pyramid_factor = 2
+pyramid_threshold = 0.88
+# Downsampled heart templates, keyed by (template scale, factor)
+_coarse_heart_templates = {}
+# Downsampled decor templates, keyed by (template id, factor)
+_coarse_decor_templates = {}
+
+# Heart icons are centered in the pikmin image, heart_pitch pixels apart
+# at reference_width. A pikmin shows one to max_heart_icons icons, so the
+# icons always sit on slots half a pitch apart around the strip center
+heart_pitch = 24
+max_heart_icons = 4
+# Pixels a heart icon can be away from its slot, at reference_width
+heart_jitter = 2
+# Pixels the center of a heart strip can be away from the middle of the
+# pikmin image, at reference_width. Column boundaries are found from the
+# heart strips, so they are never off by more than a heart pitch
+heart_search = heart_pitch
+# Score every heart icon of a strip needs for the count to be trusted.
+# Icons score 0.78 and up, the gaps between icons stay around 0.5
+heart_confidence = 0.7
+# Spread of the grayscale pixels under an icon, below which it is blank
+# background. Empty hearts are 0.026 and up, background below 0.005
+heart_min_contrast = 0.01
+# Red minus green, out of 255, above which a heart icon is filled in.
+# Full hearts are around 150, the faded hearts of pikmin that cannot be
+# picked around 36 and empty hearts below 5
+heart_fill_level = 18
 
 # Load templates and return in an array
 def load_heart_templates():
     # Load templates and convert to grayscale
     heart_templates = {}
     for key in ["full", "half", "three_quarter", "empty"]:
-        heart_templates[key] = rgb2gray(imread("../templates/template_"+key+"_heart.png")[...,0:3])
+        heart_templates[key] = template_registry.load_template_file("../templates/template_"+key+"_heart.png")
 
     # Return array of templates
     return heart_templates
 
-# Given an image, figure out how many pixels wide
-# each column is and relative positions of notable
-# features
+# Scale of a screenshot compared to the reference screen.
+# The layout scales with the width of the screen
+def get_screen_scale(image):
+    return image.shape[1] / reference_width
+
+# Use templates sized for the screen an image came from
+def use_screen_scale(image):
+    template_registry.set_scale(get_screen_scale(image))
+
+# Given an image, figure out where the pikmin list starts and ends.
+# Returns (top, bottom) rows. Found for every screenshot, and the header
+# separator line and system bar have to be near where they are on the
+# reference screen, so a stray uniform row is not taken for them
 def calculate_partition_dimensions(full_image):
-    pass
+    height, width = full_image.shape[0:2]
+    screen_scale = width / reference_width
+    search = round(bounds_search * screen_scale)
+
+    # Mean and spread of each row in a window around where a line is
+    # expected, and the first row of the window
+    def row_stats(expected, left, right):
+        start = min(max(round(expected) - search, 0), height)
+        rows = full_image[start:min(round(expected) + search + 1, height), left:right, 0:3].mean(axis=2)
+        return rows.mean(axis=1), rows.std(axis=1), start
+
+    # Runs of consecutive rows in a window, as (first, last) rows
+    # relative to the window
+    def row_runs(is_line):
+        rows = np.flatnonzero(is_line)
+        return [(run[0], run[-1]) for run in np.split(rows, np.flatnonzero(np.diff(rows) > 1) + 1) if len(run) > 0]
+
+    # The header ends with a thin uniform gray line across the screen.
+    # The sides are ignored, where the header has rounded corners
+    expected_end = (reference_crop[0] - reference_list_top_offset) * screen_scale
+    row_mean, row_std, start = row_stats(expected_end, width//10, width - width//10)
+    is_line = (row_std < 2) & (row_mean < 248)
+    # A line running past the end of the window ends too far away
+    separator_ends = [start + last for _, last in row_runs(is_line) if last < len(is_line) - 1]
+    if len(separator_ends) > 0:
+        # Last row of the separator line closest to the reference
+        separator_end = min(separator_ends, key=lambda end: abs(end - expected_end))
+        top = separator_end + round(reference_list_top_offset * screen_scale)
+    else:
+        top = round(reference_crop[0] / reference_height * height)
+
+    # The system bar is a uniform darker block at the bottom, as far
+    # from the bottom of the screen as on the reference screen
+    expected_start = height - (reference_height - reference_crop[1] - reference_list_bottom_offset) * screen_scale
+    row_mean, row_std, start = row_stats(expected_start, 0, width)
+    # The bar runs to the bottom of the screen, so only its start counts
+    bar_starts = [start + first for first, _ in row_runs((row_std < 3) & (row_mean < 200)) if first > 0]
+    if len(bar_starts) > 0:
+        bar_start = min(bar_starts, key=lambda start: abs(start - expected_start))
+        bottom = bar_start - round(reference_list_bottom_offset * screen_scale)
+    else:
+        bottom = height - round((reference_height - reference_crop[1]) * screen_scale)
+
+    print(f"List bounds for {width}x{height} screen: rows {top} to {bottom}")
+
+    return top, bottom
+
+# Figure out the column boundaries from where the hearts are. Every
+# pikmin has a strip of hearts centered in its column, so the columns are
+# the evenly spaced grid that most strip centers are on. A strip whose
+# faint last icon was not found has its center half a heart pitch off,
+# so single strips are not trusted, and the grid has to be close to the
+# reference pitch. Found for every screenshot
+def calculate_partition_sides(image, heart_y_coord):
+    height, width = image.shape[0:2]
+    screen_scale = width / reference_width
+    default_sides = [round(side * screen_scale) for side in reference_partition_sides]
+    default_pitch = np.median(np.diff(default_sides))
+
+    # Find heart X positions along each heart row, matching bands
+    # of the same height around the rows as one stack
+    heart_templates = list(template_registry.get_templates("heart").values())
+    template_h, template_w = heart_templates[0].shape
+    band_h = template_h + 20
+    if band_h > height or len(heart_y_coord) == 0:
+        print("Could not find columns, using default column boundaries")
+        return default_sides
+    band_starts = [min(max(y-10, 0), height-band_h) for y in heart_y_coord]
+    bands = to_gray(np.stack([image[start:start+band_h] for start in band_starts]))
+    profiler.count("matches.heart", len(heart_templates) * len(bands))
+    peaks = np.zeros((len(bands), width - template_w + 1), dtype=bool)
+    for result in fft_match.match_templates(bands, heart_templates):
+        peaks[:, 0:result.shape[2]] |= fft_match.peak_mask(result, 0.9, 1).any(axis=1)
+
+    # Hearts closer than half a column apart belong to the same strip
+    strip_centers = []
+    for row_peaks in peaks:
+        heart_x_coord = np.flatnonzero(row_peaks)
+        strip_start = None
+        for i, x in enumerate(heart_x_coord):
+            if strip_start is None:
+                strip_start = x
+            if i+1 == len(heart_x_coord) or heart_x_coord[i+1] - x > default_pitch/2:
+                strip_centers.append((strip_start + x + template_w) / 2)
+                strip_start = None
+    strip_centers = np.array(strip_centers)
+
+    # Every two strips in different columns give a grid. Keep the one
+    # the most strips are on, then fit it to all of those strips
+    tolerance = column_center_tolerance * screen_scale
+    best = None
+    for anchor in strip_centers:
+        columns = np.round((strip_centers - anchor) / default_pitch)
+        pitches = (strip_centers - anchor)[columns > 0] / columns[columns > 0]
+        for pitch in pitches[np.abs(pitches - default_pitch) <= column_pitch_tolerance * default_pitch]:
+            columns = np.round((strip_centers - anchor) / pitch)
+            residuals = np.abs(strip_centers - anchor - columns * pitch)
+            on_grid = residuals <= tolerance
+            key = (on_grid.sum(), -residuals[on_grid].sum())
+            if best is None or key > best[0]:
+                best = (key, columns, on_grid)
+
+    if best is None or best[0][0] < min_column_strips:
+        print("Could not find columns, using default column boundaries")
+        return default_sides
+    _, columns, on_grid = best
+    design = np.stack([np.ones(on_grid.sum()), columns[on_grid]], axis=1)
+    first_center, pitch = np.linalg.lstsq(design, strip_centers[on_grid], rcond=None)[0]
+    if abs(pitch - default_pitch) > column_pitch_tolerance * default_pitch:
+        print("Could not find columns, using default column boundaries")
+        return default_sides
+
+    # Columns across the whole screen, including ones with no pikmin
+    first_center -= np.floor((first_center - pitch/2) / pitch) * pitch
+    column_count = int((width - first_center + pitch/2) // pitch)
+    strip_centers = first_center + np.arange(max(column_count, 1)) * pitch
+
+    # Boundaries are half way between columns
+    partition_sides = [round(center - pitch/2) for center in strip_centers]
+    partition_sides.append(round(strip_centers[-1] + pitch/2))
+    partition_sides = [min(max(side, 0), width) for side in partition_sides]
+    print(f"Column boundaries for {width} wide screen: {partition_sides}")
+
+    return partition_sides
+
+# Shrink a grayscale image, or a stack of them, by averaging
+# blocks of factor x factor pixels
+def downsample(image, factor):
+    height, width = image.shape[-2] // factor * factor, image.shape[-1] // factor * factor
+    blocks = image[..., 0:height, 0:width].reshape(image.shape[:-2] + (height//factor, factor, width//factor, factor))
+
+    return blocks.mean(axis=(-3, -1))
+
+# Find rows that may have hearts on a downsampled image.
+# Returns the candidate rows in full resolution
+def find_candidate_heart_rows(image_gray, heart_templates):
+    key = (template_registry.scale, pyramid_factor)
+    if key not in _coarse_heart_templates:
+        _coarse_heart_templates[key] = [downsample(template, pyramid_factor) for template in heart_templates]
+
+    coarse = downsample(image_gray, pyramid_factor)
+    candidate_rows = []
+    profiler.count("matches.heart coarse", len(heart_templates))
+    for template_result in fft_match.match_templates(coarse, _coarse_heart_templates[key]):
+        peaks = fft_match.peak_mask(template_result, pyramid_threshold, 20 // pyramid_factor)
+        candidate_rows.extend(np.flatnonzero(peaks.any(axis=1)) * pyramid_factor)
+
+    return np.unique(candidate_rows)
+
+# Match the heart templates at full resolution, but only in bands around
+# the candidate rows. Gives the same (y, x) peaks as matching the whole
+# image with exclude_border=20, as long as every heart row is a candidate
+def refine_heart_rows(image_gray, heart_templates, candidate_rows):
+    height, width = image_gray.shape
+    template_h, template_w = fft_match.max_template_shape(heart_templates)
+    # Rows around a candidate that the heart can actually be on
+    search = pyramid_factor + 1
+    margin = 2 * pyramid_factor + 2
+    band_h = template_h + 2*margin
+    if band_h >= height:
+        return None
+
+    # Bands of the same height so they can be matched as one stack.
+    # Candidates already inside a band do not get their own
+    band_starts = []
+    for y in candidate_rows:
+        if any(start < y - search and y + search < start + band_h - template_h for start in band_starts):
+            continue
+        band_starts.append(min(max(y - margin, 0), height - band_h))
+    bands = np.stack([image_gray[start:start+band_h] for start in band_starts])
+    band_starts = np.array(band_starts)
+    profiler.count("matches.heart", len(heart_templates) * len(bands))
+
+    heart_locations = []
+    for template, template_result in zip(heart_templates, fft_match.match_templates(bands, heart_templates)):
+        peaks = fft_match.peak_mask(template_result, 0.9, 0)
+
+        # Same border as the whole image search
+        result_h = height - template.shape[0] + 1
+        peaks[:, :, :20] = False
+        peaks[:, :, -20:] = False
+        rows = band_starts[:, np.newaxis] + np.arange(peaks.shape[1])
+        peaks[(rows < 20) | (rows >= result_h - 20)] = False
+        # Edges of a band inside the image are missing neighbours
+        peaks[band_starts > 0, 0] = False
+        peaks[band_starts + band_h < height, -1] = False
+
+        band_idx, y, x = np.nonzero(peaks)
+        heart_locations.extend(zip(band_starts[band_idx] + y, x))
+
+    return heart_locations
 
 # Accepts path of image to scan
 def get_heart_locations(image):
+    use_screen_scale(image)
+
     # Load image and convert to grayscale
-    image_gray = rgb2gray(image)
+    image_gray = to_gray(image)
 
     # Find templates in image
-    results = []
-    heart_templates = load_heart_templates()
-    for key, val in heart_templates.items():
-        results.append( match_template(image_gray, val) )
+    heart_templates = template_registry.get_templates("heart")
 
     # Show image
     #fig = plt.figure(figsize=(1,1))
     #ax1 = plt.subplot(1,1,1)
     #ax1.imshow(image, cmap=plt.cm.gray)
 
+    # Find rows on a smaller image first, then only check those rows
+    heart_locations = None
+    if use_pyramid:
+        with profiler.stage("heart rows coarse"):
+            candidate_rows = find_candidate_heart_rows(image_gray, list(heart_templates.values()))
+        if len(candidate_rows) > 0:
+            with profiler.stage("heart rows refine"):
+                heart_locations = refine_heart_rows(image_gray, list(heart_templates.values()), candidate_rows)
+
     # Get heart locations and draw them on the image
-    heart_locations = []
-    for template_result in results:
-        template_h, template_w = heart_templates["full"].shape
-        for x,y in peak_local_max(template_result, threshold_abs=0.9, exclude_border=20):
-            #rect = plt.Rectangle((y, x), template_w, template_h, edgecolor='g', facecolor='none')
-            #ax1.add_patch(rect)
-            heart_locations.append([x,y])
+    if heart_locations is None:
+        with profiler.stage("heart rows full"):
+            from skimage.feature import peak_local_max
+            results = fft_match.match_templates(image_gray, list(heart_templates.values()))
+            profiler.count("matches.heart", len(heart_templates))
+            heart_locations = []
+            for template_result in results:
+                template_h, template_w = heart_templates["full"].shape
+                for x,y in peak_local_max(template_result, threshold_abs=0.9, exclude_border=20):
+                    #rect = plt.Rectangle((y, x), template_w, template_h, edgecolor='g', facecolor='none')
+                    #ax1.add_patch(rect)
+                    heart_locations.append([x,y])
 
     # Get Y coordinate of top of hearts
     heart_y_coord = np.unique( np.transpose(heart_locations)[0] )
@@ -70,15 +407,71 @@ def get_heart_locations(image):
     return heart_y_coord
 
 
+# Check every partition for a blank spot at once. The average of the
+# area checked in each partition is read from a summed area table of
+# the whole image. Returns a (rows, columns) array of booleans
+def find_blank_spots(image, partition_top, partition_bot, partition_sides):
+    height, width = image.shape[0:2]
+    # Area checked for a blank spot
+    blank_check = [round(size * get_screen_scale(image)) for size in [100, 200, 50, 150]]
+
+    # Summed in place so only the table itself is allocated
+    summed = np.zeros((height+1, width+1), dtype=np.int64)
+    image.sum(axis=2, dtype=np.int64, out=summed[1:, 1:])
+    np.cumsum(summed, axis=0, out=summed)
+    np.cumsum(summed, axis=1, out=summed)
+
+    # Bounds of the checked area, clipped to the partition and image
+    partition_top = np.clip(partition_top, 0, None)
+    partition_sides = np.asarray(partition_sides)
+    y_start = np.clip(partition_top + blank_check[0], 0, height)[:, np.newaxis]
+    y_end = np.clip(np.minimum(partition_top + blank_check[1], partition_bot), 0, height)[:, np.newaxis]
+    x_start = np.clip(partition_sides[:-1] + blank_check[2], 0, width)[np.newaxis, :]
+    x_end = np.clip(np.minimum(partition_sides[:-1] + blank_check[3], partition_sides[1:]), 0, width)[np.newaxis, :]
+    y_end = np.maximum(y_end, y_start)
+    x_end = np.maximum(x_end, x_start)
+
+    area_sum = summed[y_end, x_end] - summed[y_start, x_end] - summed[y_end, x_start] + summed[y_start, x_start]
+    area_size = (y_end - y_start) * (x_end - x_start) * image.shape[2]
+
+    # An empty area is never blank
+    return (area_size > 0) & (area_sum > 253 * area_size)
+
+# Get the most common distance between heart rows, the smallest one if
+# there is a tie. When that is not near the reference pitch, it is the
+# distance to a stray row, so the reference pitch is used instead
+def get_row_pitch(image, heart_y_coord):
+    reference_pitch = round(reference_row_pitch * get_screen_scale(image))
+    if len(heart_y_coord) < 2:
+        return reference_pitch
+    distances, distance_counts = np.unique(np.diff(heart_y_coord), return_counts=True)
+    pitch = distances[np.argmax(distance_counts)]
+    if abs(pitch - reference_pitch) > row_pitch_tolerance * reference_pitch:
+        return reference_pitch
+
+    return pitch
+
+# Drop heart rows that are not on the row grid, like a heart template
+# matching something in a pikmin image. The grid is lined up with the
+# row that has the most other rows on it, the first one if there is a tie
+def drop_off_pitch_rows(heart_y_coord, pitch):
+    heart_y_coord = np.asarray(heart_y_coord)
+    distances = heart_y_coord[np.newaxis, :] - heart_y_coord[:, np.newaxis]
+    on_grid = np.abs(distances - np.round(distances / pitch) * pitch) <= row_pitch_tolerance * pitch
+
+    return heart_y_coord[on_grid[np.argmax(on_grid.sum(axis=1))]]
+
 # Partitions an image into an array of pikmen based on
 # heart Y location
 # 
-# Returns array of pikmin images
-def partition_image(image, heart_y_coord):
+# Returns array of pikmin images, and the (row, column) of each
+# pikmin in the grid if return_positions is set
+def partition_image(image, heart_y_coord, return_positions=False):
     # Get distance between Y coordinates to determine how
     # tall a partition should be
-    heart_y_dist = stats.mode( np.diff(heart_y_coord) )[0][0]
+    heart_y_dist = get_row_pitch(image, heart_y_coord)
     print(f"Heart Y distance (pixels): {heart_y_dist}")
+    heart_y_coord = drop_off_pitch_rows(heart_y_coord, heart_y_dist)
 
     # Partition top
     # up ~200
@@ -90,24 +483,27 @@ def partition_image(image, heart_y_coord):
     partition_bot = heart_y_coord + int(1/8*heart_y_dist)
 
     # Iterate through pikmin for cropping
-    # TODO these partitions need to be changed dynamically for screen size
-    partition_sides = [25, 185, 350, 515, 675, 845]
+    partition_sides = calculate_partition_sides(image, heart_y_coord)
+    is_blank = find_blank_spots(image, partition_top, partition_bot, partition_sides)
     pikmin_images = []
+    pikmin_positions = []
     for row_idx in range(len(heart_y_coord)):
         for col_idx in range(len(partition_sides)-1):
             # Check if too far up the page
             if partition_top[row_idx] < 0:
                 continue
 
-            pikmin_image = image[partition_top[row_idx]:partition_bot[row_idx], partition_sides[col_idx]:partition_sides[col_idx+1]]
             # Check if blank spot
-            avg_value = np.average(pikmin_image[100:200, 50:150, :])
-            if (avg_value > 253):
+            if is_blank[row_idx, col_idx]:
                 continue
 
-            pikmin_images.append(pikmin_image)
+            pikmin_image = image[partition_top[row_idx]:partition_bot[row_idx], partition_sides[col_idx]:partition_sides[col_idx+1]]
 
+            pikmin_images.append(pikmin_image)
+            pikmin_positions.append((row_idx, col_idx))
 
+    if return_positions:
+        return pikmin_images, pikmin_positions
     return pikmin_images
 
 # Load user named pikmin
@@ -116,19 +512,9 @@ def get_pikmin_color_map():
     color_templates = {}
 
     for key in ["red", "yellow", "blue", "purple", "white", "winged"]:
-        color_templates[key] = [rgb2gray(imread("../templates/color_"+key+".png")[...,0:3])]
+        color_templates[key] = [template_registry.load_template_file("../templates/color_"+key+".png")]
 
-    #####################
-    # Set up custom color name map
-    #####################
-
-    # Set up variables
-    custom_template_dir = "../templates/custom/"
-    # Get all custom mapping files
-    files = glob.glob(custom_template_dir+"color_*.jpg")
-    for file in files:
-        color = file.split("color_")[-1].split("_")[0]
-        color_templates[color].append( rgb2gray(imread( file )) )
+    # Custom color name maps are looked up in color_index instead
 
     return color_templates
 
@@ -139,12 +525,8 @@ def load_friendship_templates():
         friendship_templates[key] = []
 
     # Load custom friendship templates
-    custom_template_dir = "../templates/custom/"
-    # Get all custom mapping files
-    files = glob.glob(custom_template_dir+"friendship_*.jpg")
-    for file in files:
-        friendship = file.split("friendship_")[-1].split("_")[0]
-        friendship_templates[friendship].append( rgb2gray(imread( file )) )
+    for friendship, template in template_atlas.get_templates("friendship"):
+        friendship_templates[friendship].append(template)
 
     return friendship_templates
 
@@ -160,15 +542,11 @@ def load_maturity_templates():
     files = glob.glob(template_dir+"maturity*")
     for file in files:
         maturity = file.split("maturity_")[-1].split("_")[0]
-        maturity_templates[maturity].append( rgb2gray(imread( file )[...,0:3]) )
+        maturity_templates[maturity].append( template_registry.load_template_file( file ) )
 
     # Load custom maturity templates
-    custom_template_dir = "../templates/custom/"
-    # Get all custom mapping files
-    files = glob.glob(custom_template_dir+"maturity_*.jpg")
-    for file in files:
-        maturity = file.split("maturity_")[-1].split("_")[0]
-        maturity_templates[maturity].append( rgb2gray(imread( file )) )
+    for maturity, template in template_atlas.get_templates("maturity"):
+        maturity_templates[maturity].append(template)
 
     return maturity_templates
 
@@ -178,33 +556,69 @@ def load_decor_templates():
     for key in ["yes"]:
         decor_templates[key] = []
 
-    # Load custom decor templates
-    custom_template_dir = "../templates/custom/"
-    # Get all custom mapping files
-    files = glob.glob(custom_template_dir+"decor_*.jpg")
+    # Load templates and convert to grayscale
+    template_dir = "../templates/"
+    # Get all mappings
+    files = glob.glob(template_dir+"decor*")
     for file in files:
         decor = file.split("decor_")[-1].split("_")[0]
-        decor_templates[decor].append( rgb2gray(imread( file )) )
+        decor_templates[decor].append( template_registry.load_template_file( file ) )
+
+    # Load custom decor templates
+    for decor, template in template_atlas.get_templates("decor"):
+        decor_templates[decor].append(template)
 
     return decor_templates
 
+# Templates are loaded through the registry so they are only
+# read from disk once per process
+template_registry.register_loader("heart", load_heart_templates)
+template_registry.register_loader("color", get_pikmin_color_map)
+template_registry.register_loader("friendship", load_friendship_templates)
+template_registry.register_loader("maturity", load_maturity_templates)
+template_registry.register_loader("decor", load_decor_templates)
+
+# Get the (y_start, y_end, x_start, x_end) bounds of where an
+# attribute can appear in a pikmin image of the given size
+def get_attribute_bounds(height, width, attribute_name):
+    if not use_regions:
+        return 0, height, 0, width
+
+    (top, bottom), (left, right) = attribute_regions[attribute_name]
+
+    y_start = max(int(top*height) - region_margin, 0)
+    y_end   = min(math.ceil(bottom*height) + region_margin, height)
+    x_start = max(int(left*width) - region_margin, 0)
+    x_end   = min(math.ceil(right*width) + region_margin, width)
+
+    return y_start, y_end, x_start, x_end
+
+# Get the part of a pikmin image where an attribute can appear.
+# Returns the sub image and the (y, x) offset of its top left corner
+def get_attribute_region(pikmin_image, attribute_name):
+    y_start, y_end, x_start, x_end = get_attribute_bounds(*pikmin_image.shape[0:2], attribute_name)
+
+    return pikmin_image[y_start:y_end, x_start:x_end], (y_start, x_start)
 
 # Store user defined pikmin attributes
 def store_pikmin_attribute(templates, attribute_name, key, image):
     # Sanitize key
     key = ''.join([i for i in key if i.isalnum() or i == "-"]).lower()
-    # Figure out how many templates already exist for this pikmin
-    count = len(templates[key])
-    # Name of file to save in
-    fname = f"../templates/custom/{attribute_name}_{key}_{str(count)}.jpg"
-    # Save file
-    imsave(fname, image)
+    # Stored in grayscale without JPEG loss, numbered after the
+    # templates that already exist for this pikmin. The screen scale it
+    # was cut at is kept, so it can be resized to the reference screen
+    template_atlas.add_template(attribute_name, key, template_atlas.to_template(image), template_registry.scale)
+    # Only the templates for this attribute need to be rebuilt
+    template_registry.invalidate(attribute_name)
 
     return key
 
 # Prompt user to select the maturity of the pikmin
 # for better performance
 def prompt_user_maturity(image, maturity_templates):
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import RectangleSelector, Button, RadioButtons
+
     def onselect_function(eclick, erelease):
         # Obtain (xmin, xmax, ymin, ymax) values
         # for rectangle selector box using extent attribute.
@@ -250,7 +664,57 @@ def prompt_user_maturity(image, maturity_templates):
     plt.close()
     return maturity
 
+# Prompt user to say whether the pikmin wears decor. Zooming in on
+# the decor stores it as a template for the next pikmin wearing it
+def prompt_user_decor(image, decor_templates):
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import RectangleSelector, Button, RadioButtons
+
+    def onselect_function(eclick, erelease):
+        # Obtain (xmin, xmax, ymin, ymax) values
+        # for rectangle selector box using extent attribute.
+        extent = rect_selector.extents
+        ax.set_xlim(extent[0], extent[1])
+        ax.set_ylim(extent[3], extent[2])
+    def submit_classification(val):
+        # Close window once user presses "Classify"
+        plt.close()
+
+    fix, ax = plt.subplots()
+    ax.imshow(image)
+    plt.title("Does this pikmin wear decor? Zoom in on the decor")
+
+    # Create radio
+    rax = plt.axes([0.1, 0.15, 0.2, 0.2])
+    radio_button = RadioButtons(rax, ["yes", "no"])
+
+    # Create button
+    bax = plt.axes([0.1, 0.5, 0.15, 0.1])
+    submit = Button(bax, "Classify")
+    submit.on_clicked(submit_classification)
+
+    # Rect selector for zooming
+    rect_selector = RectangleSelector(ax, onselect_function, button=[1])
+
+    # Wait for user to "Classify"
+    plt.show()
+    decor = radio_button.value_selected
+
+    # Only decor that was zoomed in on is worth keeping as a template
+    x_lim = ax.get_xlim()
+    y_lim = ax.get_ylim()
+    zoomed = x_lim[1] - x_lim[0] < image.shape[1] - 2 or y_lim[0] - y_lim[1] < image.shape[0] - 2
+    if decor == "yes" and zoomed:
+        template_to_add = image[ round(y_lim[1]):round(y_lim[0]),
+                                 round(x_lim[0]):round(x_lim[1]), :]
+        decor = store_pikmin_attribute(decor_templates, "decor", decor, template_to_add)
+    plt.close()
+    return decor
+
 def prompt_user_color(image, color_templates):
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import Button, RadioButtons
+
     def submit_classification(val):
         # Close window once user presses "Classify"
         plt.close()
@@ -275,16 +739,21 @@ def prompt_user_color(image, color_templates):
         plt.show()
         color = radio_button.value_selected
 
-    # Extract feature
+    # Extract feature, the name band color_index also reads
     #template_to_add = image[170:200, 20:140, :]
-    template_to_add = image[190:220, 20:140, :]
+    top, bottom, left, right = [round(side * template_registry.scale) for side in color_index.name_band]
+    template_to_add = image[top:bottom, left:right, :]
 
     # Store and return maturity
     color = store_pikmin_attribute(color_templates, "color", color, template_to_add)
+    color_index.invalidate()
 
     return color
 
 def prompt_user_friendship(image, friendship_templates):
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import RectangleSelector, Button, RadioButtons
+
     def onselect_function(eclick, erelease):
         # Obtain (xmin, xmax, ymin, ymax) values
         # for rectangle selector box using extent attribute.
@@ -338,176 +807,616 @@ def prompt_user_friendship(image, friendship_templates):
     return int(friendship)
 
 
-# Determine what color the pikmin is
-# based on the name
-def get_color(pikmin_image):
+# Determine what color each pikmin in a stack of same sized pikmin
+# images is based on the name, with None where no template matches.
+# images_gray is the grayscale stack, if it has already been converted
+def match_colors(pikmin_images, images_gray=None):
     # Load color templates and convert to grayscale
-    color_templates = get_pikmin_color_map()
-
-    # Convert to grayscale
-    image_gray = rgb2gray(pikmin_image)
-
-    # Determine which has a match
+    color_templates = template_registry.get_templates("color")
+    if images_gray is None:
+        images_gray = to_gray(pikmin_images)
+
+    # Only look at the name band
+    y_start, y_end, x_start, x_end = get_attribute_bounds(*images_gray.shape[1:3], "color")
+    region = images_gray[:, y_start:y_end, x_start:x_end]
+    prepared = fft_match.prepare_image(region, fft_match.max_template_shape(
+        [mapping for val in color_templates.values() for mapping in val]))
+
+    # Determine which has a match, the first color in order wins.
+    # Pikmin that matched are not matched against later templates
+    colors = [None] * len(pikmin_images)
+    remaining = np.arange(len(pikmin_images))
     for key, val in color_templates.items():
         for mapping in val:
-            result = match_template(image_gray, mapping)
-            if len( peak_local_max(result, threshold_abs=0.9, exclude_border=20) ) > 0:
-                return key
+            if len(remaining) == 0:
+                return colors
+            result = fft_match.match_prepared(prepared, mapping)
+            profiler.count("matches.color", len(remaining))
+            matched = fft_match.peak_mask(result, 0.9, 20).any(axis=(1, 2))
+            for i in remaining[matched]:
+                colors[i] = key
+            if matched.any():
+                remaining = remaining[~matched]
+                prepared = fft_match.select_prepared(prepared, ~matched)
+
+    # Pikmin without a default name may have been renamed by the user
+    if len(remaining) > 0:
+        renamed = color_index.get_index().lookup(images_gray[remaining], template_registry.scale)
+        profiler.count("color index lookups", len(remaining))
+        for i, color in zip(remaining, renamed):
+            colors[i] = color
+
+    return colors
+
+# Determine what color the pikmin is based on the name,
+# returning None if no template matches
+def match_color(pikmin_image):
+    return match_colors(pikmin_image[np.newaxis])[0]
 
-    return prompt_user_color(pikmin_image, color_templates)
-
-
-# Determine how many friendship hearts the Pikmin
-# has. This is done by determining where the left side of the leftmost heart is
-# and currently only returns how many heart icons there are
-def get_pikmin_heart_icon_count(pikmin_image):
-    image_gray = rgb2gray(pikmin_image)
-    
-    # Find templates in image
-    results = []
-    heart_templates = load_heart_templates()
-    for key, val in heart_templates.items():
-        results.append( match_template(image_gray, val) )
-
-
-    # Get all heart locations
-    heart_locations = []
-    for template_result in results:
-        template_h, template_w = heart_templates["full"].shape
-        for x,y in peak_local_max(template_result, threshold_abs=0.9, exclude_border=10):
-            heart_locations.append([x,y])
-    # Get full heart locations
-    full_heart_locations = []
-    for y,x in peak_local_max(results[0], threshold_abs=0.9, exclude_border=10):
-        full_heart_locations.append(x)
-    if len(full_heart_locations) != 0:
-        last_full_position = max(full_heart_locations)
-    else:
-        last_full_position = 0
-
-    # Get X coordinate of left heart
-    try:
-        heart_x_coord = np.unique( np.transpose(heart_locations)[1] )
-        heart_x_coord.sort()
-        left_heart = heart_x_coord[0]
-
-        # Check if last full position is full or empty by
-        # checking if Green channel is less than 150
-        x_pos = heart_x_coord[-1] + 6
-        y_pos = heart_locations[0][0] + 4
-        is_empty = pikmin_image[y_pos,x_pos,1] > 150
-
-        # Convert to number of hearts
-        if left_heart < 43:
-            # Check if last heart is a full heart
-            if last_full_position > 105 and not is_empty:
-                # Check RGB of center of this heart to see
-                # if it's full or empty
-                return 4
-            else:
-                return 3
-        # TODO need to check if these are actually one friendship lower
-        elif left_heart < 57:
-            return 2
-        elif left_heart < 67:
-            return 1
-        else:
-            return 0
-    except:
-        # Check if user has already named the heart count for this pikmin
-        friendship_templates = load_friendship_templates()
-        # Determine which has a match
-        #for key, val in friendship_templates.items():
-            #for mapping in val:
-                #result = match_template(image_gray, mapping)
-                #if len( peak_local_max(result, threshold_abs=0.98, exclude_border=20) ) > 0:
-                    #return int(key)
-
-        return int( prompt_user_friendship(pikmin_image, friendship_templates) )
+# Determine what color the pikmin is
+# based on the name
+def get_color(pikmin_image, context=None):
+    color = match_color(pikmin_image)
+    if color is not None:
+        return color
+
+    return ask_color(pikmin_image, context)
+
+# Get the color of a pikmin that did not match from the user,
+# or add it to the review queue when headless
+def ask_color(pikmin_image, context=None):
+    if headless:
+        profiler.count("queued.color")
+        review_queue.enqueue("color", pikmin_image, context)
+        return UNKNOWN
+
+    with profiler.stage("prompt wait"):
+        return prompt_user_color(pikmin_image, template_registry.get_templates("color"))
+
+
+# Read the heart strip of each pikmin in a stack of same sized pikmin
+# images. The heart band is matched against the four heart templates
+# once, then every slot an icon can be in is scored against all four at
+# the same time. The strip is the largest row of icons, centered on one
+# point near the middle, that all score heart_confidence. Returns the
+# number of icons, the kind of each icon (the template names, left to
+# right) and the score of the worst icon for each pikmin, with no icons
+# and a score of 0 where there is no heart strip
+def decode_heart_strips(pikmin_images, images_gray=None):
+    if images_gray is None:
+        images_gray = to_gray(pikmin_images)
+    count, height, width = images_gray.shape
+
+    # Only look at the heart band, keeping track of where it is
+    # so positions are still relative to the pikmin image
+    region_y, y_end, region_x, x_end = get_attribute_bounds(height, width, "hearts")
+    region = images_gray[:, region_y:y_end, region_x:x_end]
+
+    heart_templates = template_registry.get_templates("heart")
+    kinds = list(heart_templates)
+    template_h, template_w = fft_match.max_template_shape(list(heart_templates.values()))
+    responses = np.stack(fft_match.match_templates(region, list(heart_templates.values())))
+    profiler.count("matches.heart", len(heart_templates) * count)
+    response_h, response_w = responses.shape[2:4]
+
+    # The icons are on the row of the heart band where any heart template
+    # matches best. Only the band is searched even when the region is the
+    # whole image, so a heart shape elsewhere cannot be taken for the strip
+    best = responses.max(axis=0)
+    (band_top, band_bottom), _ = attribute_regions["hearts"]
+    band_start = max(int(band_top*height) - region_margin - region_y, 0)
+    band_end = max(math.ceil(band_bottom*height) + region_margin - region_y, band_start+1)
+    rows = best[:, band_start:band_end].max(axis=2).argmax(axis=1) + band_start
+
+    # How well any heart matches at each position of the row, taking the
+    # best position within jitter of it. Nearly blank background can
+    # match the empty heart outline, so positions without contrast
+    # never count as an icon
+    screen_scale = template_registry.scale
+    jitter = max(round(heart_jitter*screen_scale), 1)
+    window_y = np.clip(rows[:, np.newaxis] + np.arange(-1, 2), 0, response_h-1)
+    row_pixels = region[np.arange(count)[:, np.newaxis], rows[:, np.newaxis] + np.arange(template_h)]
+    contrast = sliding_window_view(row_pixels, template_w, axis=2)[:, :, 0:response_w].std(axis=(1, 3))
+    row_presence = best[np.arange(count)[:, np.newaxis], window_y].max(axis=1)
+    row_presence[contrast < heart_min_contrast] = 0
+    row_presence = np.pad(row_presence, ((0, 0), (jitter, jitter)), mode="edge")
+    row_presence = sliding_window_view(row_presence, 2*jitter+1, axis=1).max(axis=2)
+
+    # The strip is centered in its column, but the column boundaries
+    # can be a few pixels off. Every center within heart_search of the
+    # middle is tried, and the one with the most icons on their slots
+    # wins, then the one whose worst icon scores best, then the one
+    # closest to the middle. Icons half a pitch off their slots always
+    # give fewer icons, so the strip cannot be read a slot off
+    slot_offsets = np.round(np.arange(1 - max_heart_icons, max_heart_icons) * heart_pitch / 2 * screen_scale).astype(int)
+    middle = round(width/2 - template_w/2) - region_x
+    search = round(heart_search*screen_scale)
+    centers = np.arange(middle - search, middle + search + 1)
+    slot_positions = np.clip(centers[:, np.newaxis] + slot_offsets, 0, response_w-1)
+    slot_presence = row_presence[:, slot_positions]
+    center_icons = np.zeros((count, len(centers)), dtype=int)
+    center_scores = np.zeros((count, len(centers)))
+    for n in range(1, max_heart_icons+1):
+        slots = np.arange(max_heart_icons - n, max_heart_icons + n - 1, 2)
+        strip_scores = slot_presence[:, :, slots].min(axis=2)
+        found = strip_scores >= heart_confidence
+        center_icons[found] = n
+        center_scores[found] = strip_scores[found]
+    ranking = center_icons + center_scores / 2 - np.abs(centers - middle) / (4*search + 4)
+    chosen = ranking.argmax(axis=1)
+    strip_center = centers[chosen]
+    icons = center_icons[np.arange(count), chosen]
+    icon_scores = center_scores[np.arange(count), chosen]
+
+    # Top left corner of every slot, and the positions around it
+    # an icon is looked for, (pikmin, slot, position)
+    slot_x = strip_center[:, np.newaxis] + slot_offsets
+    window_x = np.clip(slot_x[:, :, np.newaxis] + np.arange(-jitter, jitter+1), 0, response_w-1)
+
+    # Score of every template in every slot, (pikmin, slot, template)
+    window = (np.arange(count)[:, np.newaxis, np.newaxis, np.newaxis], window_y[:, :, np.newaxis, np.newaxis],
+              window_x[:, np.newaxis])
+    windows = responses[(slice(None),) + window]
+    scores = windows.max(axis=(2, 4)).transpose(1, 2, 0)
+
+    # Full and empty hearts have the same shape and only differ in
+    # color, so whether a heart is filled in is read from how red its
+    # center is. Grayscale cannot tell an empty heart from a faded one
+    window_best = best[window].transpose(0, 2, 1, 3).reshape(count, len(slot_offsets), -1).argmax(axis=2)
+    icon_y = window_y[np.arange(count)[:, np.newaxis], window_best // window_x.shape[2]] + region_y + template_h//2
+    icon_x = window_x[np.arange(count)[:, np.newaxis], np.arange(len(slot_offsets)), window_best % window_x.shape[2]] + \
+        region_x + template_w//2
+    center = np.arange(-2, 3)
+    center_y = np.clip(icon_y[..., np.newaxis, np.newaxis] + center[:, np.newaxis], 0, height-1)
+    center_x = np.clip(icon_x[..., np.newaxis, np.newaxis] + center, 0, width-1)
+    center_pixels = pikmin_images[window[0], center_y, center_x].astype(int)
+    filled = np.median(center_pixels[..., 0] - center_pixels[..., 1], axis=(2, 3)) > heart_fill_level
+    kind_idx = scores.argmax(axis=2)
+    uniform = np.isin(kind_idx, [kinds.index("full"), kinds.index("empty")])
+    kind_idx = np.where(uniform, np.where(filled, kinds.index("full"), kinds.index("empty")), kind_idx)
+
+    icon_kinds = []
+    for i in range(count):
+        slots = np.arange(max_heart_icons - icons[i], max_heart_icons + icons[i] - 1, 2)
+        icon_kinds.append([kinds[k] for k in kind_idx[i, slots]])
+
+    return icons, icon_kinds, icon_scores
+
+# Determine how many friendship hearts each Pikmin in a stack of same
+# sized pikmin images has, with None where there is no heart strip. The
+# last icon shows progress towards the next heart, so the count is one
+# less than the number of icons, unless all four icons are full. Also
+# returns how well the worst icon of each pikmin matched if
+# return_scores is set
+def match_heart_icon_counts(pikmin_images, images_gray=None, return_scores=False):
+    icons, icon_kinds, icon_scores = decode_heart_strips(pikmin_images, images_gray)
+
+    hearts = []
+    heart_scores = []
+    for count, kinds, score in zip(icons, icon_kinds, icon_scores):
+        if count == 0:
+            hearts.append(None)
+            heart_scores.append(None)
+            continue
+        hearts.append(max_heart_icons if count == max_heart_icons and kinds[-1] == "full" else int(count) - 1)
+        heart_scores.append(round(float(score), 4))
+
+    if return_scores:
+        return hearts, heart_scores
+    return hearts
+
+# Determine how many friendship hearts the Pikmin has,
+# returning None if the hearts could not be read
+def match_heart_icon_count(pikmin_image):
+    return match_heart_icon_counts(pikmin_image[np.newaxis])[0]
+
+# Determine how many friendship hearts the Pikmin has,
+# falling back to the user (or review queue) if they cannot be read
+def get_pikmin_heart_icon_count(pikmin_image, context=None):
+    hearts = match_heart_icon_count(pikmin_image)
+    if hearts is not None:
+        return hearts
+
+    return ask_heart_icon_count(pikmin_image, context)
+
+# Get the heart count of a pikmin that did not match from the user,
+# or add it to the review queue when headless
+def ask_heart_icon_count(pikmin_image, context=None):
+    if headless:
+        profiler.count("queued.friendship")
+        review_queue.enqueue("friendship", pikmin_image, context)
+        return None
+
+    with profiler.stage("prompt wait"):
+        return int( prompt_user_friendship(pikmin_image, template_registry.get_templates("friendship")) )
 
 def crop_image(image_path):
-    # TODO need to change this to detect the top and bottom
-    # of selection screen for someone else's phone
-
     # Load image and crop top/bottom
-    image = imread(image_path)
+    with profiler.stage("imread"):
+        image = imread(image_path)
     print(image.shape)
-    cropped = image[410:1650,:,:]
+    with profiler.stage("crop"):
+        top, bottom = calculate_partition_dimensions(image)
+        cropped = image[top:bottom,:,:]
 
     return cropped
 
+# Convert an 8 bit RGB image, or a stack of them, to grayscale in
+# gray_dtype. Only the output is allocated in that precision, rgb2gray
+# would first make a float64 copy of every channel
+def to_gray(image):
+    if gray_dtype == np.float64:
+        return rgb2gray(image)
+
+    gray = np.multiply(image[..., 0], gray_weights[0] / 255, dtype=gray_dtype)
+    for channel in [1, 2]:
+        gray += np.multiply(image[..., channel], gray_weights[channel] / 255, dtype=gray_dtype)
+
+    return gray
+
 # Determine whether a pikmin has been selected for the challenge
-# based on average color of bottom line of partitioned area
+# based on average color of bottom line of partitioned area.
+# Also works on a stack of pikmin images, giving an array of flags
 def check_if_selected(image):
     # Get last line of section
-    cropped_bottom = list(image[-1,:,0])
+    cropped_bottom = image[...,-1,:,0]
 
     # Get left half and right, ignoring middle in case pikmin
     # below is sticking up
-    section_length = int(len(cropped_bottom)/4)
-    left_pixels  = cropped_bottom[0:section_length]
-    right_pixels = cropped_bottom[-section_length:]
+    section_length = int(cropped_bottom.shape[-1]/4)
+    left_pixels  = cropped_bottom[...,0:section_length]
+    right_pixels = cropped_bottom[...,-section_length:]
 
     # Average the parts to see if not white
-    left_avg = np.average(left_pixels)
-    right_avg = np.average(right_pixels)
+    left_avg = np.average(left_pixels, axis=-1)
+    right_avg = np.average(right_pixels, axis=-1)
 
     threshold = 248
-    return left_avg < threshold or right_avg < threshold
-
-# Determine what the maturity of the pikmin is
-def get_maturity(pikmin_image):
-    maturity_templates = load_maturity_templates()
+    return (left_avg < threshold) | (right_avg < threshold)
+
+# Determine what the maturity of each pikmin in a stack of same sized
+# pikmin images is, with None where no template matches.
+# images_gray is the grayscale stack, if it has already been converted.
+#
+# Templates are tried in the order of how often they won before, and
+# a pikmin stops being matched once a maturity scores above
+# maturity_confidence. Otherwise the maturity with the most matches
+# wins. Also returns the best score of each winning maturity
+# if return_scores is set
+def match_maturities(pikmin_images, images_gray=None, return_scores=False):
+    maturity_templates = template_registry.get_templates("maturity")
+    count = len(pikmin_images)
 
     # Convert to grayscale
-    sub_image = pikmin_image[0:100,:,:]
-    image_gray = rgb2gray(sub_image)
+    if images_gray is None:
+        images_gray = to_gray(pikmin_images)
+    sub_image = images_gray[:,0:round(maturity_rows*template_registry.scale),:]
+    prepared = fft_match.prepare_image(sub_image, fft_match.max_template_shape(
+        [mapping for val in maturity_templates.values() for mapping in val]))
+
+    # Count matches of each maturity for every pikmin, and keep the
+    # best score of each maturity and which template it came from
+    keys = list(maturity_templates)
+    match_count = np.zeros((count, len(keys)), dtype=int)
+    best_score = np.zeros((count, len(keys)))
+    best_template = np.full((count, len(keys)), None, dtype=object)
+    confident_key = np.full(count, -1)
+    remaining = np.arange(count)
+    match_calls = 0
+    for key, template_key, mapping in template_ranking.rank("maturity", maturity_templates):
+        if len(remaining) == 0:
+            break
+        key_idx = keys.index(key)
+        result = fft_match.match_prepared(prepared, mapping)
+        match_calls += len(remaining)
+
+        peaks = fft_match.peak_mask(result, 0.9, 5)
+        match_count[remaining, key_idx] += peaks.sum(axis=(1, 2))
+        scores = np.where(peaks, result, 0).max(axis=(1, 2))
+        better = scores > best_score[remaining, key_idx]
+        best_score[remaining[better], key_idx] = scores[better]
+        best_template[remaining[better], key_idx] = template_key
+
+        # Pikmin that are clearly this maturity are done
+        confident = scores >= maturity_confidence
+        if confident.any():
+            confident_key[remaining[confident]] = key_idx
+            remaining = remaining[~confident]
+            prepared = fft_match.select_prepared(prepared, ~confident)
+    template_ranking.record_matches("maturity", count, match_calls)
+    profiler.count("matches.maturity", match_calls)
+
+    # Otherwise most matches wins, ties go to the first maturity in order
+    maturities = []
+    maturity_scores = []
+    for i in range(count):
+        key_idx = confident_key[i] if confident_key[i] >= 0 else np.argmax(match_count[i])
+        if match_count[i, key_idx] < 1:
+            maturities.append(None)
+            maturity_scores.append(None)
+            continue
+        maturities.append(keys[key_idx])
+        maturity_scores.append(float(best_score[i, key_idx]))
+        template_ranking.record_win("maturity", best_template[i, key_idx])
 
-    # Determine which has a match
-    match_count = {}
-    for key, val in maturity_templates.items():
-        match_count[key] = 0
-        for mapping in val:
-            #print(f" Gray shape: {image_gray.shape}    Mapping shape: {mapping.shape}")
-            result = match_template(image_gray, mapping)
-            peaks = peak_local_max(result, threshold_abs=0.9, exclude_border=5)
-            match_count[key] += len( peaks )
-
-    # Check if any matches
-    if max(match_count.values()) < 1:
-        return prompt_user_maturity(sub_image, maturity_templates)
-    else:
-        return max(match_count, key=match_count.get)
+    if return_scores:
+        return maturities, maturity_scores
+    return maturities
 
-def identify_image(path_to_image):
+# Determine what the maturity of the pikmin is,
+# returning None if no template matches
+def match_maturity(pikmin_image):
+    return match_maturities(pikmin_image[np.newaxis])[0]
+
+# Determine what the maturity of the pikmin is
+def get_maturity(pikmin_image, context=None):
+    maturity = match_maturity(pikmin_image)
+    if maturity is not None:
+        return maturity
+
+    return ask_maturity(pikmin_image, context)
+
+# Get the maturity of a pikmin that did not match from the user,
+# or add it to the review queue when headless
+def ask_maturity(pikmin_image, context=None):
+    if headless:
+        profiler.count("queued.maturity")
+        review_queue.enqueue("maturity", pikmin_image, context)
+        return UNKNOWN
+
+    with profiler.stage("prompt wait"):
+        return prompt_user_maturity(pikmin_image[0:round(maturity_rows*template_registry.scale),:,:],
+                                    template_registry.get_templates("maturity"))
+
+# Determine which pikmin in a stack of same sized pikmin images wear
+# decor. Gives "yes" where a decor template matches and None where none
+# does, since the pikmin may wear decor there is no template for yet
+def match_decors(pikmin_images, images_gray=None):
+    decor_templates = template_registry.get_templates("decor")
+    count = len(pikmin_images)
+    if images_gray is None:
+        images_gray = to_gray(pikmin_images)
+
+    # Only look at the pikmin itself
+    y_start, y_end, x_start, x_end = get_attribute_bounds(*images_gray.shape[1:3], "decor")
+    region = images_gray[:, y_start:y_end, x_start:x_end]
+    # Templates cut from a larger screen may not fit
+    ranked = [entry for entry in template_ranking.rank("decor", decor_templates)
+              if entry[2].shape[0] <= region.shape[1] and entry[2].shape[1] <= region.shape[2]]
+    ranked = ranked[0:decor_max_templates]
+    decors = [None] * count
+    if len(ranked) == 0:
+        return decors
+
+    # Most pikmin wear no decor, and are ruled out on the smaller region
+    for key, template_key, mapping in ranked:
+        if (template_key, pyramid_factor) not in _coarse_decor_templates:
+            _coarse_decor_templates[(template_key, pyramid_factor)] = downsample(mapping, pyramid_factor)
+    coarse_templates = [_coarse_decor_templates[(template_key, pyramid_factor)] for key, template_key, mapping in ranked]
+    prepared = fft_match.prepare_image(downsample(region, pyramid_factor),
+                                       fft_match.max_template_shape(coarse_templates))
+    coarse_score = np.zeros(count)
+    for template in coarse_templates:
+        coarse_score = np.maximum(coarse_score, fft_match.match_prepared(prepared, template).max(axis=(1, 2)))
+    match_calls = count * len(coarse_templates)
+    remaining = np.flatnonzero(coarse_score >= decor_screen_threshold)
+
+    # Pikmin that matched are not matched against later templates
+    if len(remaining) > 0:
+        prepared = fft_match.prepare_image(region[remaining], fft_match.max_template_shape([entry[2] for entry in ranked]))
+    for key, template_key, mapping in ranked:
+        if len(remaining) == 0:
+            break
+        result = fft_match.match_prepared(prepared, mapping)
+        match_calls += len(remaining)
+        scores = result.max(axis=(1, 2))
+
+        matched = scores >= decor_threshold
+        if matched.any():
+            for i in remaining[matched]:
+                decors[i] = key
+                template_ranking.record_win("decor", template_key)
+            remaining = remaining[~matched]
+            prepared = fft_match.select_prepared(prepared, ~matched)
+    template_ranking.record_matches("decor", count, match_calls)
+    profiler.count("matches.decor", match_calls)
+
+    return decors
+
+# Determine whether the pikmin wears decor,
+# returning None if no decor template matches
+def match_decor(pikmin_image):
+    return match_decors(pikmin_image[np.newaxis])[0]
+
+# Determine whether the pikmin wears decor
+def get_decor(pikmin_image, context=None):
+    decor = match_decor(pikmin_image)
+    if decor is not None:
+        return decor
+
+    return ask_decor(pikmin_image, context)
+
+# Get whether a pikmin wears decor from the user when it could
+# not be told, or add it to the review queue when headless
+def ask_decor(pikmin_image, context=None):
+    if headless:
+        profiler.count("queued.decor")
+        review_queue.enqueue("decor", pikmin_image, context)
+        return UNKNOWN
+
+    with profiler.stage("prompt wait"):
+        return prompt_user_decor(pikmin_image, template_registry.get_templates("decor"))
+
+# Classify every pikmin image at once. Images of the same size are
+# stacked into one array, converted to grayscale once and matched
+# against each template in one go. Returns (selected, hearts, hearts
+# score, color, maturity, maturity score, decor) for each image, with
+# None for fields that did not match
+def classify_pikmin(pikmin_images):
+    classified = [None] * len(pikmin_images)
+
+    # Partitions can differ in size by a pixel or two
+    groups = {}
+    for i, pikmin_image in enumerate(pikmin_images):
+        groups.setdefault(pikmin_image.shape, []).append(i)
+
+    for indices in groups.values():
+        with profiler.stage("grayscale"):
+            stack = np.stack([pikmin_images[i] for i in indices])
+            stack_gray = to_gray(stack)
+
+        with profiler.stage("selected"):
+            selected = check_if_selected(stack)
+        with profiler.stage("hearts"):
+            hearts, heart_scores = match_heart_icon_counts(stack, stack_gray, return_scores=True)
+        with profiler.stage("color"):
+            colors = match_colors(stack, stack_gray)
+        with profiler.stage("maturity"):
+            maturities, maturity_scores = match_maturities(stack, stack_gray, return_scores=True)
+        decors = [None] * len(indices)
+        if detect_decor:
+            with profiler.stage("decor"):
+                decors = match_decors(stack, stack_gray)
+
+        results = zip(selected, hearts, heart_scores, colors, maturities, maturity_scores, decors)
+        for i, (is_selected, hearts, heart_score, color, maturity, maturity_score, decor) in zip(indices, results):
+            classified[i] = (bool(is_selected), hearts, heart_score, color, maturity, maturity_score, decor)
+
+    return classified
+
+# Identify every pikmin in a screenshot. If crops is a dictionary, the
+# image of every pikmin with a field a learned template could still
+# change is added to it by index, so the field can be rescanned later
+def identify_image(path_to_image, crops=None):
     # Crop image to get rid of location/system buttons
     cropped = crop_image(path_to_image)
 
     # Get heart locations and partition image
-    heart_y_coord = get_heart_locations(cropped)
+    with profiler.stage("heart rows"):
+        heart_y_coord = get_heart_locations(cropped)
     print(f"y coord: {heart_y_coord}")
-    pikmin_images = partition_image(cropped, heart_y_coord)
 
+    return identify_partitions(cropped, heart_y_coord, path_to_image, crops)
+
+# Identify every pikmin in a cropped image whose heart rows are
+# already known. source_name is stored in the records as the file
+def identify_partitions(cropped, heart_y_coord, source_name, crops=None):
+    use_screen_scale(cropped)
+    with profiler.stage("partition"):
+        pikmin_images, pikmin_positions = partition_image(cropped, heart_y_coord, return_positions=True)
+    with profiler.stage("classify"):
+        classified = classify_pikmin(pikmin_images)
+    profiler.count("pikmin", len(pikmin_images))
+
+    # One record per identified pikmin
+    pikmin_records = []
     for i in range(len(pikmin_images)):
-        # Check if pikmin is selected
-        is_selected = check_if_selected( pikmin_images[i] )
+        # Where this pikmin came from, in case it has to be reviewed later
+        context = {"file": source_name, "index": i}
+        is_selected, pikmin_hearts, hearts_score, color, maturity, maturity_score, decor = classified[i]
 
-        pikmin_hearts = get_pikmin_heart_icon_count( pikmin_images[i] )
+        # Pikmin that did not match are asked about or queued for review
+        if pikmin_hearts is None:
+            pikmin_hearts = ask_heart_icon_count( pikmin_images[i], context )
 
         # If no hearts were found, this is because it's hidden behind
         # a button or cut off the screen
         #print(f"Pikmin hearts: {pikmin_hearts}")
-        if (pikmin_hearts < 0):
+        if (pikmin_hearts is not None and pikmin_hearts < 0):
             continue
 
-        color = get_color( pikmin_images[i] )
-        maturity = get_maturity( pikmin_images[i] )
-        # TODO get decor
+        if color is None:
+            color = ask_color( pikmin_images[i], context )
+        if maturity is None:
+            maturity = ask_maturity( pikmin_images[i], context )
+        if decor is None and detect_decor:
+            decor = ask_decor( pikmin_images[i], context )
         #print(f"is selecetd: {is_selected}")
-        print(f"Pikmin {str(i).rjust(2)} is a {color.rjust(7)} with {maturity.rjust(6)} and {pikmin_hearts} heart icons : Selected = {is_selected}")
+        print(f"Pikmin {str(i).rjust(2)} is a {color.rjust(7)} with {maturity.rjust(6)} and {pikmin_hearts} heart icons : Selected = {is_selected} : Decor = {decor}")
+        # Fields left unknown, and maturities that never matched
+        # confidently, could still change with a new template
+        fields = [("color", color), ("maturity", maturity), ("hearts", pikmin_hearts)]
+        if detect_decor:
+            fields.append(("decor", decor))
+        unresolved = [field for field, value in fields if value is None or value == UNKNOWN]
+        if maturity_score is not None and maturity_score < maturity_confidence:
+            unresolved.append("maturity")
+        if crops is not None and any(field in rescan_attributes for field in unresolved):
+            crops[i] = pikmin_images[i]
+        with profiler.stage("perceptual hash"):
+            phash = dedup.format_hash(dedup.perceptual_hash(pikmin_images[i]))
+        pikmin_records.append({
+            "file": source_name,
+            "index": i,
+            "row": pikmin_positions[i][0],
+            "column": pikmin_positions[i][1],
+            "color": color,
+            "maturity": maturity,
+            # How well the maturity matched, None if it was entered by hand
+            "maturity_score": maturity_score,
+            "hearts": pikmin_hearts,
+            # How well the worst heart icon matched, None if entered by hand
+            "hearts_score": hearts_score,
+            "selected": bool(is_selected),
+            "decor": decor,
+            # Fields that rescan_records can try again with new templates
+            "unresolved": unresolved,
+            # Used to find the same pikmin in other screenshots
+            "phash": phash,
+        })
+    # Keep which templates won for the next screenshot and run
+    template_ranking.save()
+
+    return pikmin_records
+
+# Match the unresolved fields of records from an earlier scan again,
+# using the crops kept by identify_image. Only fields whose attribute
+# got new templates are matched, given as a set of attribute names, and
+# only for the pikmin where they were unresolved. Each field is matched
+# against every template, so the result is the same as scanning the
+# screenshot again. Returns the crops that are still unresolved
+def rescan_records(records, crops, attributes):
+    by_index = {record["index"]: record for record in records}
+
+    # Partitions can differ in size by a pixel or two
+    groups = {}
+    for index, crop in crops.items():
+        groups.setdefault(crop.shape, []).append(index)
+
+    for indices in groups.values():
+        stack = np.stack([crops[index] for index in indices])
+        stack_gray = to_gray(stack)
+        for field, attribute_name in rescan_attributes.items():
+            if attribute_name not in attributes:
+                continue
+            rows = [row for row, index in enumerate(indices) if field in by_index[index]["unresolved"]]
+            if len(rows) == 0:
+                continue
 
-    # TODO save data to CSV
-    # TODO create function to compare to other screenshots
+            scores = [None] * len(rows)
+            with profiler.stage(field):
+                if field == "color":
+                    values = match_colors(stack[rows], stack_gray[rows])
+                elif field == "maturity":
+                    values, scores = match_maturities(stack[rows], stack_gray[rows], return_scores=True)
+                else:
+                    values = match_decors(stack[rows], stack_gray[rows])
+            profiler.count(f"rescanned.{field}", len(rows))
+
+            for row, value, score in zip(rows, values, scores):
+                if value is None:
+                    continue
+                record = by_index[indices[row]]
+                record[field] = value
+                if field == "maturity":
+                    record["maturity_score"] = score
+                    if score < maturity_confidence:
+                        continue
+                record["unresolved"].remove(field)
+    template_ranking.save()
+
+    return {index: crop for index, crop in crops.items()
+            if any(field in rescan_attributes for field in by_index[index]["unresolved"])}
 
 
 if __name__ == "__main__":
@@ -516,6 +1425,9 @@ if __name__ == "__main__":
     #identify_image("../screenshots/small_hearts.jpg")
     #identify_image("../screenshots/blue_leaves.jpg")
     #identify_image("../screenshots/Screenshot_20220325-232646.jpg")
+    template_registry.print_stats()
+    template_ranking.print_stats()
+    profiler.print_summary()
 
     exit()
     files = glob.glob("../screenshots/*.jpg")
@@ -0,0 +1,145 @@
+#!/bin/python3
+
+# Timers and counters for each stage of a scan, so optimisations can be
+# checked against real batches. Worker processes collect theirs after
+# each screenshot and the main process adds them up.
+
+import contextlib
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is not reported there
+    resource = None
+
+# Total seconds and number of runs of each stage
+timings = {}
+# Named counts, like template matches per attribute
+counters = {}
+# Largest value seen of named measurements, like peak memory
+peaks = {}
+
+# Counter dictionaries kept by other modules, {name: dict}. They are
+# reported as the change since the last collect
+_sources = {}
+_source_baselines = {}
+# Cache hit rates to report, {cache name: (hits counter, misses counter)}
+_hit_rates = {}
+
+# Time a block of code as a stage
+@contextlib.contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+def add_time(name, seconds, runs=1):
+    total, count = timings.get(name, (0, 0))
+    timings[name] = (total + seconds, count + runs)
+
+def count(name, amount=1):
+    counters[name] = counters.get(name, 0) + amount
+
+def record_peak(name, value):
+    peaks[name] = max(peaks.get(name, value), value)
+
+# Largest resident memory of this process so far in MB, or None
+# if it cannot be measured on this platform
+def peak_rss_mb():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else
+    if sys.platform == "darwin":
+        return max_rss / 2**20
+    return max_rss / 2**10
+
+# Report the counters of another module, e.g. cache statistics.
+# hit_rates maps a cache name to the (hits, misses) keys in the counters
+def register_counters(name, source, hit_rates=None):
+    _sources[name] = source
+    _source_baselines[name] = dict(source)
+    for cache_name, (hits, misses) in (hit_rates or {}).items():
+        _hit_rates[cache_name] = (f"{name}.{hits}", f"{name}.{misses}")
+
+# Take everything measured since the last collect and start again.
+# The result can be sent between processes and passed to merge
+def collect():
+    collected_counters = dict(counters)
+    for name, source in _sources.items():
+        baseline = _source_baselines[name]
+        for key, value in source.items():
+            previous = baseline.get(key, 0)
+            # The module may have reset its counters since
+            if value < previous:
+                previous = 0
+            if value != previous:
+                collected_counters[f"{name}.{key}"] = value - previous
+        _source_baselines[name] = dict(source)
+    collected = {"timings": dict(timings), "counters": collected_counters, "peaks": dict(peaks)}
+
+    timings.clear()
+    counters.clear()
+    peaks.clear()
+
+    return collected
+
+# Add measurements collected in another process
+def merge(collected):
+    for name, (seconds, runs) in collected["timings"].items():
+        add_time(name, seconds, runs)
+    for name, amount in collected["counters"].items():
+        count(name, amount)
+    for name, value in collected["peaks"].items():
+        record_peak(name, value)
+
+# Everything measured so far as a dictionary that can be saved as JSON
+def summary():
+    collected = collect()
+    merge(collected)
+
+    stages = {}
+    for name, (seconds, runs) in sorted(timings.items(), key=lambda item: -item[1][0]):
+        stages[name] = {"seconds": round(seconds, 4), "runs": runs, "mean_ms": round(seconds / runs * 1000, 3)}
+
+    caches = {}
+    for cache_name, (hits, misses) in _hit_rates.items():
+        hit_count = counters.get(hits, 0)
+        miss_count = counters.get(misses, 0)
+        if hit_count + miss_count > 0:
+            caches[cache_name] = {"hits": hit_count, "misses": miss_count,
+                                  "hit_rate": round(hit_count / (hit_count + miss_count), 4)}
+
+    return {"stages": stages, "counters": dict(sorted(counters.items())), "caches": caches,
+            "peaks": dict(sorted(peaks.items()))}
+
+def print_summary():
+    profile = summary()
+    for name, stage_summary in profile["stages"].items():
+        print(f"{name:24s} {stage_summary['seconds']:8.3f}s {stage_summary['runs']:6d} runs {stage_summary['mean_ms']:9.2f}ms each")
+    for name, amount in profile["counters"].items():
+        print(f"{name:40s} {amount}")
+    for name, cache_summary in profile["caches"].items():
+        print(f"{name} cache: {cache_summary['hit_rate']:.0%} hit rate ({cache_summary['hits']} hits, {cache_summary['misses']} misses)")
+    for name, value in profile["peaks"].items():
+        print(f"{name:40s} {value:.1f}")
+
+# Save the summary of a run, along with any details about the run
+def dump(path, run=None):
+    profile = summary()
+    if run is not None:
+        profile = {"run": run, **profile}
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+
+# Forget everything measured so far
+def reset():
+    collect()
+    timings.clear()
+    counters.clear()
+    peaks.clear()
@@ -0,0 +1,224 @@
+#!/bin/python3
+
+# Persistent cache of identify_image results so screenshots that were
+# already scanned are not template matched again. Entries are keyed by
+# the content of the screenshot and a fingerprint of the template set,
+# so learning a new template only invalidates results computed before it.
+#
+# Pikmin with fields a learned template could still change keep their
+# crop next to the results. When the only change since a screenshot was
+# scanned is new custom templates, only those pikmin are matched again.
+
+import numpy as np
+
+import glob
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import time
+
+import pikmin_image_parser
+import profiler
+import template_atlas
+
+cache_path = "../cache/results.sqlite"
+template_dir = "../templates/"
+# Most entries to keep, least recently used entries are removed first
+max_entries = 10000
+# Change when the fields of the records change so old results are not reused
+record_version = 9
+
+# Counters for the current process
+stats = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "rescans": 0,
+}
+profiler.register_counters("result_cache", stats, {"result": ("hits", "misses")})
+
+# Connection for this process, opened when first needed
+_connection = None
+
+def get_connection():
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Several worker processes can share the cache, wait for their writes
+        _connection = sqlite3.connect(cache_path, timeout=30)
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                content_hash TEXT NOT NULL,
+                template_fingerprint TEXT NOT NULL,
+                records TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (content_hash, template_fingerprint)
+            )""")
+        _connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        # What rescanning a result needs: the built in templates and
+        # custom templates it was made with, the screen scale and the
+        # crops of pikmin that were unresolved
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS rescan (
+                content_hash TEXT NOT NULL,
+                template_fingerprint TEXT NOT NULL,
+                base_fingerprint TEXT NOT NULL,
+                atlas_state TEXT NOT NULL,
+                scale REAL NOT NULL,
+                crops BLOB NOT NULL,
+                PRIMARY KEY (content_hash, template_fingerprint)
+            )""")
+        _connection.commit()
+
+    return _connection
+
+# Close the connection, e.g. before changing cache_path
+def close():
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
+
+# Hash of the contents of a screenshot
+def content_hash(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+# Hash of the contents of a group of stitched screenshots
+def group_hash(paths):
+    hasher = hashlib.sha256()
+    for path in paths:
+        hasher.update(f"{content_hash(path)}\n".encode())
+
+    return hasher.hexdigest()
+
+# Fingerprint of the built in template files. Uses names, sizes and
+# modification times, which is cheap to check and changes whenever a
+# template is changed
+def base_fingerprint():
+    hasher = hashlib.sha256(f"records:{record_version}\n".encode())
+    # Records scanned without decor have no decor to reuse
+    hasher.update(f"decor:{pikmin_image_parser.detect_decor}\n".encode())
+    custom_dir = os.path.abspath(template_atlas.custom_template_dir)
+    files = glob.glob(os.path.join(template_dir, "**", "*.*"), recursive=True)
+    for file in sorted(files):
+        # Skip files built from the templates, like the color index, and
+        # custom templates, which are loaded from the template atlas
+        if not file.lower().endswith((".png", ".jpg", ".jpeg")) or \
+                os.path.abspath(file).startswith(custom_dir):
+            continue
+        file_stat = os.stat(file)
+        hasher.update(f"{os.path.relpath(file, template_dir)}:{file_stat.st_size}:{file_stat.st_mtime_ns}\n".encode())
+
+    return hasher.hexdigest()
+
+# Fingerprint of every template, built in and custom. The atlas
+# index changes whenever a custom template is stored. The index the
+# loaded atlas was read from is used, not the one on disk, so records
+# are never stored under templates they were not matched with
+def template_fingerprint():
+    hasher = hashlib.sha256(base_fingerprint().encode())
+    stamp = template_atlas.get_atlas().stamp
+    if stamp is not None:
+        hasher.update(f"atlas:{stamp[0]}:{stamp[1]}\n".encode())
+
+    return hasher.hexdigest()
+
+# Get the cached records for a screenshot, or None if it
+# has not been scanned with the current templates. file_hash can be
+# given instead of hashing the file, e.g. from group_hash
+def get(path, fingerprint=None, file_hash=None):
+    if fingerprint is None:
+        fingerprint = template_fingerprint()
+    if file_hash is None:
+        file_hash = content_hash(path)
+    key = (file_hash, fingerprint)
+
+    connection = get_connection()
+    row = connection.execute(
+        "SELECT records FROM results WHERE content_hash = ? AND template_fingerprint = ?", key).fetchone()
+    if row is None:
+        stats["misses"] += 1
+        return None
+
+    connection.execute(
+        "UPDATE results SET last_used = ? WHERE content_hash = ? AND template_fingerprint = ?",
+        (time.time(),) + key)
+    connection.commit()
+    stats["hits"] += 1
+
+    return json.loads(row[0])
+
+# Store the records for a screenshot, along with the crops of unresolved
+# pikmin by index and the screen scale they were matched at
+def put(path, pikmin_records, fingerprint=None, crops=None, scale=1.0, file_hash=None):
+    if fingerprint is None:
+        fingerprint = template_fingerprint()
+    if file_hash is None:
+        file_hash = content_hash(path)
+
+    connection = get_connection()
+    # Results from older template sets will never be used again
+    for table in ["results", "rescan"]:
+        connection.execute(
+            f"DELETE FROM {table} WHERE content_hash = ? AND template_fingerprint != ?", (file_hash, fingerprint))
+    connection.execute(
+        "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+        (file_hash, fingerprint, json.dumps(pikmin_records), time.time()))
+    connection.execute(
+        "INSERT OR REPLACE INTO rescan VALUES (?, ?, ?, ?, ?, ?)",
+        (file_hash, fingerprint, base_fingerprint(), json.dumps(template_atlas.state()), scale,
+         pack_crops(crops or {})))
+    evict(connection)
+    connection.commit()
+
+# Crops as one compressed blob, most of a pikmin crop is flat background
+def pack_crops(crops):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **{str(index): crop for index, crop in crops.items()})
+
+    return buffer.getvalue()
+
+def unpack_crops(blob):
+    with np.load(io.BytesIO(blob)) as packed:
+        return {int(index): packed[index] for index in packed.files}
+
+# Get what is needed to rescan a screenshot that was scanned with other
+# templates, as (records, base fingerprint, atlas state, scale, crops),
+# or None if it was never scanned
+def get_previous(path, file_hash=None):
+    if file_hash is None:
+        file_hash = content_hash(path)
+    row = get_connection().execute(
+        "SELECT r.records, s.base_fingerprint, s.atlas_state, s.scale, s.crops FROM results r "
+        "JOIN rescan s ON r.content_hash = s.content_hash AND r.template_fingerprint = s.template_fingerprint "
+        "WHERE r.content_hash = ? ORDER BY r.last_used DESC LIMIT 1", (file_hash,)).fetchone()
+    if row is None:
+        return None
+
+    records, base, atlas_state, scale, crops = row
+    return json.loads(records), base, json.loads(atlas_state), scale, unpack_crops(crops)
+
+# Remove least recently used entries over the size cap
+def evict(connection):
+    count = connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    if count <= max_entries:
+        return
+
+    cursor = connection.execute(
+        "DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY last_used LIMIT ?)",
+        (count - max_entries,))
+    stats["evictions"] += cursor.rowcount
+    connection.execute(
+        "DELETE FROM rescan WHERE NOT EXISTS (SELECT 1 FROM results r WHERE r.content_hash = rescan.content_hash "
+        "AND r.template_fingerprint = rescan.template_fingerprint)")
+
+def print_stats():
+    print(f"Result cache hits: {stats['hits']}, misses: {stats['misses']}, evictions: {stats['evictions']}, "
+          f"rescans: {stats['rescans']}")
@@ -0,0 +1,93 @@
+#!/bin/python3
+
+# Write pikmin records to a file as each screenshot finishes, so a
+# large batch never has to keep every result in memory.
+# Supported formats are CSV, JSON Lines and Parquet (needs pyarrow).
+# CSV and JSON Lines files can also be appended to.
+
+import csv
+import json
+import os
+
+# Columns written for every pikmin, in order
+fields = ["file", "index", "row", "column", "color", "maturity", "hearts", "selected", "decor"]
+
+class CsvWriter:
+    def __init__(self, path, append=False):
+        has_header = append and os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, "a" if append else "w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=fields, extrasaction="ignore")
+        if not has_header:
+            self.writer.writeheader()
+
+    def write(self, pikmin_records):
+        self.writer.writerows(pikmin_records)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class JsonLinesWriter:
+    def __init__(self, path, append=False):
+        self.file = open(path, "a" if append else "w")
+
+    def write(self, pikmin_records):
+        for record in pikmin_records:
+            self.file.write(json.dumps({key: record.get(key) for key in fields}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# Columnar output, each screenshot is written as its own row group
+class ParquetWriter:
+    def __init__(self, path, append=False):
+        if append and os.path.exists(path):
+            raise ValueError(f"Cannot append to the Parquet file '{path}', write to a new file instead")
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Writing Parquet files requires pyarrow (pip install pyarrow)")
+
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ("file", pyarrow.string()),
+            ("index", pyarrow.int32()),
+            ("row", pyarrow.int32()),
+            ("column", pyarrow.int32()),
+            ("color", pyarrow.string()),
+            ("maturity", pyarrow.string()),
+            ("hearts", pyarrow.int32()),
+            ("selected", pyarrow.bool_()),
+            ("decor", pyarrow.string()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, pikmin_records):
+        if len(pikmin_records) == 0:
+            return
+        columns = {key: [record.get(key) for record in pikmin_records] for key in fields}
+        self.writer.write_table(self.pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+writers = {
+    "csv": CsvWriter,
+    "jsonl": JsonLinesWriter,
+    "parquet": ParquetWriter,
+}
+
+# Open a writer for a path, picking the format from
+# the file extension if it is not given. When appending,
+# records are added after the ones already in the file
+def open_writer(path, output_format=None, append=False):
+    if output_format is None:
+        output_format = path.rsplit(".", 1)[-1].lower()
+        if output_format == "json":
+            output_format = "jsonl"
+    if output_format not in writers:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {', '.join(writers)}")
+
+    return writers[output_format](path, append)
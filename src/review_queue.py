@@ -0,0 +1,158 @@
+#!/bin/python3
+
+# Queue of pikmin that could not be classified during a headless scan.
+# Each entry is a crop of the pikmin plus a JSON file saying which field
+# is unknown and where the pikmin came from, so all of them can be
+# reviewed in one sitting after the scan has finished.
+
+from skimage.io import imread, imsave
+
+import glob
+import json
+import os
+import uuid
+
+import pikmin_image_parser
+import template_registry
+
+pending_dir = "../review/pending/"
+resolved_dir = "../review/resolved/"
+
+# Add a pikmin crop to the review queue
+def enqueue(field, pikmin_image, context=None):
+    os.makedirs(pending_dir, exist_ok=True)
+
+    # Each entry gets its own files so worker processes never
+    # write to the same file
+    entry_id = uuid.uuid4().hex
+    image_path = os.path.join(pending_dir, f"{entry_id}.png")
+    imsave(image_path, pikmin_image, check_contrast=False)
+
+    entry = {
+        "id": entry_id,
+        "field": field,
+        "image": image_path,
+        "context": context or {},
+        # Screen scale of the scan, which the crop is cut at
+        "scale": template_registry.scale,
+    }
+    with open(os.path.join(pending_dir, f"{entry_id}.json"), "w") as f:
+        json.dump(entry, f)
+
+    return entry_id
+
+# Load all entries in a queue directory
+def load_entries(queue_dir):
+    entries = []
+    for file in sorted(glob.glob(os.path.join(queue_dir, "*.json"))):
+        with open(file) as f:
+            entries.append(json.load(f))
+
+    return entries
+
+# Try to classify a queued crop with the templates that exist now
+def match_field(field, image):
+    if field == "color":
+        return pikmin_image_parser.match_color(image)
+    elif field == "maturity":
+        return pikmin_image_parser.match_maturity(image)
+    elif field == "friendship":
+        return pikmin_image_parser.match_heart_icon_count(image)
+    elif field == "decor":
+        return pikmin_image_parser.match_decor(image)
+
+# Ask the user to classify a queued crop, storing a new template.
+# The crop must be at template_registry.scale
+def prompt_field(field, image):
+    if field == "color":
+        return pikmin_image_parser.prompt_user_color(image, template_registry.get_templates("color"))
+    elif field == "maturity":
+        rows = round(pikmin_image_parser.maturity_rows * template_registry.scale)
+        return pikmin_image_parser.prompt_user_maturity(image[0:rows,:,:], template_registry.get_templates("maturity"))
+    elif field == "friendship":
+        return int(pikmin_image_parser.prompt_user_friendship(image, template_registry.get_templates("friendship")))
+    elif field == "decor":
+        return pikmin_image_parser.prompt_user_decor(image, template_registry.get_templates("decor"))
+
+# Move an entry from the pending queue to the resolved queue
+def resolve_entry(entry, value):
+    os.makedirs(resolved_dir, exist_ok=True)
+
+    entry["value"] = value
+    image_path = os.path.join(resolved_dir, os.path.basename(entry["image"]))
+    os.replace(entry["image"], image_path)
+    entry["image"] = image_path
+
+    with open(os.path.join(resolved_dir, entry["id"]+".json"), "w") as f:
+        json.dump(entry, f)
+    os.remove(os.path.join(pending_dir, entry["id"]+".json"))
+
+# Go through every pending entry. Templates learned from earlier
+# entries are tried first, so renamed pikmin that show up in several
+# screenshots only need to be classified once
+def review_pending():
+    entries = load_entries(pending_dir)
+    entries.sort(key=lambda entry: (str(entry["context"].get("file")), entry["context"].get("index", 0)))
+    print(f"{len(entries)} pikmin waiting for review")
+
+    prompted = 0
+    for entry in entries:
+        image = imread(entry["image"])[...,0:3]
+        # Match and cut templates at the size of the screen it came from
+        template_registry.set_scale(entry.get("scale", 1.0))
+        value = match_field(entry["field"], image)
+        if value is None:
+            value = prompt_field(entry["field"], image)
+            prompted += 1
+
+        resolve_entry(entry, value)
+        print(f"{entry['context']} {entry['field']} = {value}")
+
+    print(f"Resolved {len(entries)} pikmin, {prompted} needed a prompt")
+
+# Map of (file, index) to the fields resolved by review
+def load_resolutions():
+    resolutions = {}
+    for entry in load_entries(resolved_dir):
+        context = entry["context"]
+        key = (context.get("file"), context.get("index"))
+        resolutions.setdefault(key, {})[entry["field"]] = entry["value"]
+
+    return resolutions
+
+# Resolutions kept between screenshots, with the modification time of
+# the resolved directory they were loaded at
+_resolutions = None
+_resolutions_mtime = None
+
+# Get the resolutions, only reading the resolved entries again
+# once something has been resolved since they were loaded
+def get_resolutions():
+    global _resolutions, _resolutions_mtime
+    mtime = os.stat(resolved_dir).st_mtime_ns if os.path.isdir(resolved_dir) else None
+    if _resolutions is None or mtime != _resolutions_mtime:
+        _resolutions = load_resolutions()
+        _resolutions_mtime = mtime
+
+    return _resolutions
+
+# Fill in unknown fields of the records from identify_image
+# with the values resolved during review
+def apply_resolutions(path_to_image, pikmin_records, resolutions=None):
+    if resolutions is None:
+        resolutions = get_resolutions()
+
+    # Record keys differ from the queue field names for hearts
+    record_keys = {"color": "color", "maturity": "maturity", "friendship": "hearts", "decor": "decor"}
+    for record in pikmin_records:
+        resolved = resolutions.get((path_to_image, record["index"]), {})
+        for field, value in resolved.items():
+            record[record_keys[field]] = value
+            # Answered by hand, so new templates should not change it
+            if record_keys[field] in record.get("unresolved", []):
+                record["unresolved"].remove(record_keys[field])
+
+    return pikmin_records
+
+if __name__ == "__main__":
+    review_pending()
@@ -0,0 +1,294 @@
+#!/bin/python3
+
+# Local HTTP service that scans screenshots uploaded by several people
+# with one shared set of templates. Uploads wait on a bounded queue and
+# are identified by a pool of worker processes that keep the templates
+# loaded between screenshots. Results are streamed back as JSON lines,
+# one per pikmin.
+#
+#   POST /scan?name=file.jpg   body is the screenshot, returns JSON lines
+#   GET /status                queue, worker and cache statistics
+#
+# When the queue is full, uploads are turned away with 503 and a
+# Retry-After header instead of piling up. Only the standard library is
+# used, so the service runs wherever the scanner does.
+
+from concurrent.futures import ProcessPoolExecutor
+
+import argparse
+import asyncio
+import hashlib
+import http.client
+import json
+import os
+import urllib.parse
+
+import batch_scan
+import profiler
+
+host = "127.0.0.1"
+port = 8765
+# Screenshots waiting for a worker before uploads are turned away
+queue_size = 16
+# Uploads being received at once, more connections wait their turn
+max_connections = 32
+# Largest screenshot accepted
+max_upload_bytes = 20 * 2**20
+# Seconds a client gets to send its request
+request_timeout = 30
+# Uploads are kept by content, so the same screenshot sent twice is one
+# file and the result cache and review queue can refer to it
+upload_dir = "../cache/uploads/"
+
+# File types accepted, by the bytes they start with
+image_signatures = {b"\xff\xd8\xff": ".jpg", b"\x89PNG\r\n\x1a\n": ".png"}
+
+statuses = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 411: "Length Required",
+            413: "Payload Too Large", 415: "Unsupported Media Type", 503: "Service Unavailable"}
+
+class HttpError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+# A screenshot waiting to be identified, and where its result goes
+class ScanJob:
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.result = asyncio.get_running_loop().create_future()
+
+class ScanService:
+    def __init__(self, workers=None, cache=True, decor=False):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.connections = asyncio.Semaphore(max_connections)
+        # Worker processes load every template set once when they start
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=batch_scan.init_worker,
+                                        initargs=(True, cache, decor))
+        self.stats = {"accepted": 0, "rejected": 0, "scanned": 0, "failed": 0, "active": 0}
+        self.consumers = []
+        self.server = None
+
+    async def start(self, bind_host=host, bind_port=port):
+        # One consumer per worker, so no more screenshots are handed to
+        # the pool than it can work on and the rest wait on the queue
+        self.consumers = [asyncio.create_task(self.consume()) for _ in range(self.workers)]
+        # Start the workers now so the first upload does not wait for the templates to load
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, os.getpid) for _ in range(self.workers)])
+        self.server = await asyncio.start_server(self.handle, bind_host, bind_port)
+
+        return self.server.sockets[0].getsockname()[0:2]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for consumer in self.consumers:
+            consumer.cancel()
+        await asyncio.gather(*self.consumers, return_exceptions=True)
+        self.pool.shutdown(cancel_futures=True)
+
+    # Identify queued screenshots one at a time in the worker pool
+    async def consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            self.stats["active"] += 1
+            try:
+                _, records, elapsed, measured = await loop.run_in_executor(self.pool, batch_scan.scan_file, job.path)
+                profiler.merge(measured)
+                for record in records:
+                    record["file"] = job.name
+                self.stats["scanned"] += 1
+                job.result.set_result((records, elapsed))
+            except Exception as error:
+                self.stats["failed"] += 1
+                if not job.result.done():
+                    job.result.set_exception(error)
+            finally:
+                self.stats["active"] -= 1
+                self.queue.task_done()
+
+    async def handle(self, reader, writer):
+        async with self.connections:
+            try:
+                method, target, headers = await asyncio.wait_for(read_request_head(reader), request_timeout)
+                url = urllib.parse.urlsplit(target)
+                if url.path == "/scan":
+                    if method != "POST":
+                        raise HttpError(405, "Use POST to upload a screenshot", {"Allow": "POST"})
+                    body = await asyncio.wait_for(read_body(reader, headers), request_timeout)
+                    query = urllib.parse.parse_qs(url.query)
+                    await self.scan(writer, body, query.get("name", ["screenshot"])[0])
+                elif url.path == "/status":
+                    if method != "GET":
+                        raise HttpError(405, "Use GET for the status", {"Allow": "GET"})
+                    write_head(writer, 200, "application/json")
+                    writer.write(json.dumps(self.status(), indent=1).encode())
+                else:
+                    raise HttpError(404, f"No such path {url.path}")
+            except HttpError as error:
+                write_head(writer, error.status, "application/json", error.headers)
+                writer.write(json.dumps({"error": str(error)}).encode() + b"\n")
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                # Client went away or sent something unreadable
+                pass
+            finally:
+                try:
+                    await writer.drain()
+                    writer.close()
+                    await writer.wait_closed()
+                except ConnectionError:
+                    pass
+
+    # Queue an uploaded screenshot and stream its records back
+    async def scan(self, writer, body, name):
+        path = save_upload(body)
+        job = ScanJob(path, name)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise HttpError(503, "Too many screenshots waiting, try again later", {"Retry-After": "1"})
+        self.stats["accepted"] += 1
+
+        write_head(writer, 200, "application/x-ndjson")
+        write_line(writer, {"status": "queued", "name": name, "waiting": self.queue.qsize()})
+        await writer.drain()
+
+        try:
+            records, elapsed = await job.result
+        except Exception as error:
+            write_line(writer, {"status": "error", "name": name, "error": str(error)})
+            return
+        for record in records:
+            write_line(writer, record)
+            # Slow clients hold up only their own response
+            await writer.drain()
+        write_line(writer, {"status": "done", "name": name, "pikmin": len(records), "seconds": round(elapsed, 3)})
+
+    def status(self):
+        return {
+            "workers": self.workers,
+            "waiting": self.queue.qsize(),
+            "queue_size": queue_size,
+            **self.stats,
+            "profile": profiler.summary(),
+        }
+
+# Read the request line and headers, returning (method, target, headers)
+async def read_request_head(reader):
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    parts = request_line.split()
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise HttpError(400, "Malformed request line")
+
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1")
+        if line in ("\r\n", "\n", ""):
+            break
+        key, _, value = line.partition(":")
+        headers[key.strip().lower()] = value.strip()
+        if len(headers) > 100:
+            raise HttpError(400, "Too many headers")
+
+    return parts[0].upper(), parts[1], headers
+
+async def read_body(reader, headers):
+    if "content-length" not in headers:
+        raise HttpError(411, "Content-Length is required")
+    if not headers["content-length"].isdigit():
+        raise HttpError(400, "Malformed Content-Length")
+    length = int(headers["content-length"])
+    if length > max_upload_bytes:
+        raise HttpError(413, f"Screenshots can be at most {max_upload_bytes} bytes")
+
+    return await reader.readexactly(length)
+
+# Store an upload under the hash of its content, returning the path
+def save_upload(body):
+    extension = next((ext for signature, ext in image_signatures.items() if body.startswith(signature)), None)
+    if extension is None:
+        raise HttpError(415, "Only JPEG and PNG screenshots can be scanned")
+
+    os.makedirs(upload_dir, exist_ok=True)
+    path = os.path.join(upload_dir, hashlib.sha256(body).hexdigest() + extension)
+    if not os.path.exists(path):
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(body)
+        os.replace(temp_path, path)
+
+    return path
+
+# Responses have no length and end when the connection closes,
+# so records can be sent as soon as they are ready
+def write_head(writer, status, content_type, headers=None):
+    lines = [f"HTTP/1.1 {status} {statuses[status]}", f"Content-Type: {content_type}", "Connection: close"]
+    lines += [f"{key}: {value}" for key, value in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+def write_line(writer, item):
+    writer.write(json.dumps(item).encode() + b"\n")
+
+async def serve(bind_host, bind_port, workers, cache, decor=False):
+    service = ScanService(workers, cache, decor)
+    bound_host, bound_port = await service.start(bind_host, bind_port)
+    print(f"Scanning screenshots sent to http://{bound_host}:{bound_port}/scan with {service.workers} workers, "
+          f"press Ctrl+C to stop")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.stop()
+
+# Upload a screenshot to a running service, yielding each JSON line of
+# the response as it arrives
+def submit(path, server_host=host, server_port=port):
+    with open(path, "rb") as f:
+        body = f.read()
+    connection = http.client.HTTPConnection(server_host, server_port)
+    try:
+        connection.request("POST", "/scan?" + urllib.parse.urlencode({"name": os.path.basename(path)}), body,
+                           {"Content-Type": "application/octet-stream"})
+        response = connection.getresponse()
+        for line in response:
+            item = json.loads(line)
+            if response.status != 200:
+                raise RuntimeError(f"{response.status} {response.reason}: {item['error']}")
+            yield item
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan screenshots uploaded to a local HTTP service")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="run the service")
+    serve_parser.add_argument("--host", default=host, help="address to listen on")
+    serve_parser.add_argument("--port", type=int, default=port, help="port to listen on")
+    serve_parser.add_argument("-w", "--workers", type=int, default=None,
+                              help="worker processes (default: one per CPU)")
+    serve_parser.add_argument("--queue-size", type=int, default=queue_size,
+                              help="screenshots that can wait for a worker")
+    serve_parser.add_argument("--no-cache", action="store_true", help="always scan screenshots again")
+    serve_parser.add_argument("--decor", action="store_true",
+                              help="read whether pikmin wear decor, queueing every pikmin no decor template matches")
+    submit_parser = subparsers.add_parser("submit", help="send screenshots to a running service")
+    submit_parser.add_argument("screenshots", nargs="+")
+    submit_parser.add_argument("--host", default=host)
+    submit_parser.add_argument("--port", type=int, default=port)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        queue_size = args.queue_size
+        try:
+            asyncio.run(serve(args.host, args.port, args.workers, not args.no_cache, args.decor))
+        except KeyboardInterrupt:
+            print()
+    else:
+        for path in batch_scan.expand_inputs(args.screenshots):
+            for item in submit(path, args.host, args.port):
+                print(json.dumps(item))
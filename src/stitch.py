@@ -0,0 +1,136 @@
+#!/bin/python3
+
+# Stitch consecutive screenshots of a scrolled challenge list into one
+# tall image, so rows that appear in both screenshots are only
+# partitioned and classified once.
+#
+# The offset between two screenshots has to line up their heart rows,
+# so only offsets that do are tried. Each one is scored by comparing
+# a small per-row signature of both images where they overlap.
+
+import numpy as np
+
+import pikmin_image_parser
+
+# Number of column bins in the per-row signature
+signature_bins = 16
+# Pixels around each heart row based offset to also try
+offset_search = 3
+# Fewest rows that have to overlap to count as stitched
+min_overlap = 100
+# Largest mean difference (grayscale, 0 to 1) of a good overlap
+max_overlap_error = 0.02
+
+# Mean brightness of each row in a few column bins. Small enough to
+# compare many offsets, but keeps more detail than a single row average
+def row_signature(cropped):
+    gray = pikmin_image_parser.to_gray(cropped)
+    height, width = gray.shape
+    bin_width = width // signature_bins
+    gray = gray[:, 0:bin_width*signature_bins]
+
+    return gray.reshape(height, signature_bins, bin_width).mean(axis=2)
+
+# Find how far down the first image the second one starts, i.e. the
+# offset where lower[y] matches upper[y + offset]. Returns None if
+# the screenshots do not overlap
+def estimate_offset(upper_signature, upper_hearts, lower_signature, lower_hearts):
+    upper_height = upper_signature.shape[0]
+    lower_height = lower_signature.shape[0]
+
+    # Offsets that line up some pair of heart rows
+    candidates = set()
+    for upper_y in upper_hearts:
+        for lower_y in lower_hearts:
+            for delta in range(-offset_search, offset_search+1):
+                candidates.add(int(upper_y) - int(lower_y) + delta)
+
+    best_offset = None
+    best_error = max_overlap_error
+    for offset in candidates:
+        overlap = min(upper_height - offset, lower_height)
+        if offset <= 0 or overlap < min_overlap:
+            continue
+
+        error = np.mean(np.abs(upper_signature[offset:offset+overlap] - lower_signature[0:overlap]))
+        if error < best_error:
+            best_offset = offset
+            best_error = error
+
+    return best_offset
+
+# Put the lower image below the upper one, starting at offset
+def merge(upper, lower, offset):
+    return np.concatenate([upper[0:offset], lower], axis=0)
+
+# Heart rows of the stitched image from the rows found in each screenshot
+def merge_heart_rows(upper_hearts, lower_hearts, offset):
+    heart_y_coord = np.concatenate([upper_hearts, np.asarray(lower_hearts) + offset])
+    heart_y_coord.sort()
+
+    # Same clean up as get_heart_locations for rows found in both
+    for i in range(len(heart_y_coord)-1):
+        if abs(heart_y_coord[i] - heart_y_coord[i+1]) < 5:
+            heart_y_coord[i+1] = heart_y_coord[i]
+
+    return np.unique(heart_y_coord)
+
+# Crop a screenshot and find its heart rows and row signature. Run in
+# the worker processes, so only these small results have to be sent
+# back and the cropped image is dropped straight away
+def prepare_screenshot(path):
+    cropped = pikmin_image_parser.crop_image(path)
+    heart_y_coord = pikmin_image_parser.get_heart_locations(cropped)
+
+    return path, heart_y_coord, row_signature(cropped)
+
+# Group consecutive screenshots that overlap, given the results of
+# prepare_screenshot in order. Yields (paths, start of each screenshot
+# in the stitched image, heart rows) for each group as soon as the next
+# screenshot shows it is complete, so only one group is kept at a time
+def group_screenshots(prepared):
+    group = None
+    previous_signature = None
+    for path, heart_y_coord, signature in prepared:
+        offset = None
+        if previous_signature is not None:
+            offset = estimate_offset(previous_signature, previous_hearts, signature, heart_y_coord)
+
+        if offset is None:
+            if group is not None:
+                yield tuple(group)
+            group = [[path], [0], heart_y_coord]
+        else:
+            # Offsets are relative to the previous screenshot
+            start = group[1][-1] + offset
+            print(f"Stitching {path} {offset} rows below the previous screenshot")
+            group[0].append(path)
+            group[1].append(start)
+            group[2] = merge_heart_rows(group[2], heart_y_coord, start)
+
+        previous_signature = signature
+        previous_hearts = heart_y_coord
+
+    if group is not None:
+        yield tuple(group)
+
+# Name used for a group in the records
+def group_name(paths):
+    return "+".join(paths)
+
+# Crop the screenshots of a group again and put them together
+def stitch_group(paths, starts):
+    image = None
+    for path, start in zip(paths, starts):
+        cropped = pikmin_image_parser.crop_image(path)
+        image = cropped if image is None else merge(image, cropped, start)
+
+    return image
+
+# Identify every pikmin in a group from group_screenshots, keeping
+# the crops of unresolved pikmin if crops is given
+def identify_group(group, crops=None):
+    paths, starts, heart_y_coord = group
+    image = stitch_group(paths, starts)
+
+    return pikmin_image_parser.identify_partitions(image, heart_y_coord, group_name(paths), crops)
@@ -0,0 +1,308 @@
+#!/bin/python3
+
+# Packed store of the custom templates learned from prompts. Every
+# template is kept as a grayscale float64 array in one data file, which
+# is memory mapped, with a JSON index giving the name, attribute, label,
+# offset, shape and source screen scale of each one. Loading needs no
+# glob or image decoding, and templates are stored without JPEG loss.
+#
+# New templates are appended to the end of the data file and the index
+# is replaced afterwards, so a crash never leaves the index pointing at
+# pixels that were not written. Readers with the old index simply do
+# not see the new template. Writers hold a lock on the atlas from
+# reading the index until the new one is in place, so processes adding
+# templates at the same time take turns.
+#
+# Custom templates from before the atlas, templates/custom/{attribute}_
+# {label}_{n}.jpg, are imported the first time the atlas is loaded. They
+# can also be imported and exported by hand, see the bottom of the file.
+
+import numpy as np
+from skimage.color import rgb2gray
+from skimage.io import imread, imsave
+
+import argparse
+import contextlib
+import fcntl
+import glob
+import json
+import os
+
+custom_template_dir = "../templates/custom/"
+data_path = "../templates/custom/atlas.bin"
+index_path = "../templates/custom/atlas.json"
+lock_path = "../templates/custom/atlas.lock"
+
+dtype = np.float64
+# Change when the layout of the data file changes
+atlas_version = 1
+# Image files in the directory layout, as written before the atlas
+template_extensions = (".jpg", ".jpeg", ".png")
+
+# Loaded atlas, shared by every loader in the process
+_atlas = None
+
+class TemplateAtlas:
+    def __init__(self, entries=None, data=None, stamp=None):
+        # {"name", "attribute", "label", "offset", "shape", "scale"} of each
+        # template. scale is the size of the screen it was cut from relative
+        # to the reference screen, and is missing from older entries
+        self.entries = entries if entries is not None else []
+        # Pixels of every template, memory mapped from the data file
+        self.data = data if data is not None else np.zeros(0, dtype=dtype)
+        self.names = {entry["name"] for entry in self.entries}
+        # (size, modification time) of the index that was read,
+        # None when there was no index
+        self.stamp = stamp
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Array of a template, a read only view of the data file
+    def template(self, entry):
+        size = int(np.prod(entry["shape"]))
+        return np.asarray(self.data[entry["offset"]:entry["offset"]+size]).reshape(entry["shape"])
+
+    # Array of a template at the size it would have on the reference
+    # screen, like the built in templates
+    def reference_template(self, entry):
+        template = self.template(entry)
+        source_scale = entry.get("scale", 1.0)
+        if source_scale != 1.0:
+            # skimage.transform is slow to import, so only load it once needed
+            from skimage.transform import rescale
+            template = rescale(template, 1 / source_scale, anti_aliasing=True)
+
+        return template
+
+    # (label, template) of every template for an attribute at the
+    # reference scale, in the order they were added
+    def get_templates(self, attribute_name):
+        return [(entry["label"], self.reference_template(entry)) for entry in self.entries
+                if entry["attribute"] == attribute_name]
+
+# Convert an image the way template_registry.load_template_file does,
+# so imported templates match exactly as they did as files
+def to_template(image):
+    if image.ndim == 3:
+        return rgb2gray(image[...,0:3])
+    return image.astype(dtype) / 255 if image.dtype == np.uint8 else image.astype(dtype)
+
+# Read the index and map the data file
+def _read(index_file=None, data_file=None):
+    index_file = index_file or index_path
+    data_file = data_file or data_path
+    if not os.path.exists(index_file):
+        return TemplateAtlas()
+
+    # The index is replaced, never rewritten, so the open file
+    # is the one the stamp is taken from
+    with open(index_file) as f:
+        file_stat = os.fstat(f.fileno())
+        index = json.load(f)
+    if index.get("version") != atlas_version:
+        raise ValueError(f"{index_file} was written by another version of the template atlas")
+
+    data = None
+    if len(index["templates"]) > 0:
+        data = np.memmap(data_file, dtype=dtype, mode="r", shape=(os.path.getsize(data_file) // np.dtype(dtype).itemsize,))
+
+    return TemplateAtlas(index["templates"], data, (file_stat.st_size, file_stat.st_mtime_ns))
+
+# Get the atlas, loading it the first time it is needed. Before the
+# atlas existed, custom templates were separate files, so those are
+# imported into a new atlas
+def get_atlas():
+    global _atlas
+    if _atlas is None:
+        if not os.path.exists(index_path) and len(list_template_files(custom_template_dir)) > 0:
+            imported = import_directory(custom_template_dir)
+            print(f"Imported {imported} custom templates into {index_path}")
+        _atlas = _read()
+
+    return _atlas
+
+# (label, template) of every custom template for an attribute
+def get_templates(attribute_name):
+    return get_atlas().get_templates(attribute_name)
+
+# Summary of the atlas as it is now, to find out later which
+# attributes got new templates since
+def state():
+    atlas = get_atlas()
+
+    return {"count": len(atlas), "last": atlas.entries[-1]["name"] if len(atlas) > 0 else None}
+
+# Attributes that got new templates since an earlier state(), or None
+# if templates were not only appended, like when the atlas was replaced
+def added_since(earlier):
+    atlas = get_atlas()
+    count = earlier["count"]
+    if count > len(atlas) or (count > 0 and atlas.entries[count-1]["name"] != earlier["last"]):
+        return None
+
+    return {entry["attribute"] for entry in atlas.entries[count:]}
+
+# Load the atlas again the next time it is used
+def invalidate():
+    global _atlas
+    _atlas = None
+
+# Whether the index on disk is not the one the loaded atlas was read
+# from, like after another process added a template
+def changed_on_disk():
+    if _atlas is None:
+        return False
+    try:
+        file_stat = os.stat(index_path)
+    except FileNotFoundError:
+        return _atlas.stamp is not None
+
+    return _atlas.stamp != (file_stat.st_size, file_stat.st_mtime_ns)
+
+# Load the atlas again if it changed on disk. Returns the attributes
+# that got new templates, or None if anything may have changed
+def reload_if_changed():
+    if not changed_on_disk():
+        return set()
+    earlier = state()
+    invalidate()
+
+    return added_since(earlier)
+
+# Hold the atlas lock, so only one process changes the atlas at a time
+@contextlib.contextmanager
+def _locked():
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+# Write the index next to the old one and swap it in, so readers
+# never see a partly written index. Each process writes its own file,
+# in case a writer that does not hold the lock is still running
+def _write_index(entries):
+    temp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"version": atlas_version, "dtype": np.dtype(dtype).name, "templates": entries}, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, index_path)
+
+# Append templates to the atlas, given as (attribute, label, template,
+# name, scale) with name None to number it after the templates with the
+# same attribute and label, and scale the screen scale the template was
+# cut at. Templates with a name that is already in the atlas are
+# skipped. Returns the names the templates were stored as
+def add_templates(templates):
+    with _locked():
+        added = _append(templates)
+    invalidate()
+
+    return added
+
+# Append templates with the atlas lock held
+def _append(templates):
+    # Read the index from disk, another process may have added to it
+    atlas = _read()
+    entries = list(atlas.entries)
+    names = set(atlas.names)
+    itemsize = np.dtype(dtype).itemsize
+
+    added = []
+    with open(data_path, "ab") as f:
+        # Skip past anything left by an append that did not finish
+        size = os.fstat(f.fileno()).st_size
+        offset = -(-size // itemsize)
+        f.write(b"\0" * (offset * itemsize - size))
+        for attribute_name, label, template, name, source_scale in templates:
+            if name in names:
+                continue
+            if name is None:
+                count = sum(1 for entry in entries if entry["attribute"] == attribute_name and entry["label"] == label)
+                name = f"{attribute_name}_{label}_{count}"
+                while name in names:
+                    count += 1
+                    name = f"{attribute_name}_{label}_{count}"
+            template = np.ascontiguousarray(template, dtype=dtype)
+            f.write(template.tobytes())
+            entries.append({"name": name, "attribute": attribute_name, "label": label,
+                            "offset": offset, "shape": list(template.shape), "scale": float(source_scale)})
+            names.add(name)
+            offset += template.size
+            added.append(name)
+        # The pixels must be on disk before the index points at them
+        f.flush()
+        os.fsync(f.fileno())
+    _write_index(entries)
+
+    return added
+
+# Add a single template learned from a prompt on a screen of the given
+# scale, returning its name
+def add_template(attribute_name, label, template, source_scale=1.0):
+    return add_templates([(attribute_name, label, template, None, source_scale)])[0]
+
+# Template image files in the directory layout from before the atlas
+def list_template_files(directory):
+    files = []
+    for file in sorted(glob.glob(os.path.join(directory, "*_*_*.*"))):
+        if file.lower().endswith(template_extensions):
+            files.append(file)
+
+    return files
+
+# Import {attribute}_{label}_{n} image files from a directory, skipping
+# names that are already in the atlas. Returns how many were imported
+def import_directory(directory):
+    names = _read().names
+    templates = []
+    for file in list_template_files(directory):
+        name = os.path.splitext(os.path.basename(file))[0]
+        if name in names:
+            continue
+        attribute_name, label = name.split("_")[0:2]
+        templates.append((attribute_name, label, to_template(imread(file)), name, 1.0))
+    if len(templates) == 0:
+        return 0
+
+    return len(add_templates(templates))
+
+# Write every template to a directory as {name}.png, the layout
+# import_directory reads. PNG keeps the grayscale values to 8 bits.
+# Files have no scale, so templates are written at the reference scale
+def export_directory(directory):
+    os.makedirs(directory, exist_ok=True)
+    atlas = _read()
+    for entry in atlas.entries:
+        image = np.round(np.clip(atlas.reference_template(entry), 0, 1) * 255).astype(np.uint8)
+        imsave(os.path.join(directory, entry["name"] + ".png"), image, check_contrast=False)
+
+    return len(atlas)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import, export and list the packed custom templates")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="add {attribute}_{label}_{n} image files to the atlas")
+    import_parser.add_argument("directory", nargs="?", default=custom_template_dir)
+    export_parser = subparsers.add_parser("export", help="write every template as a PNG file")
+    export_parser.add_argument("directory")
+    subparsers.add_parser("list", help="count the templates of each attribute and label")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        print(f"Imported {import_directory(args.directory)} templates from {args.directory}")
+    elif args.command == "export":
+        print(f"Exported {export_directory(args.directory)} templates to {args.directory}")
+    else:
+        counts = {}
+        for entry in _read().entries:
+            key = (entry["attribute"], entry["label"])
+            counts[key] = counts.get(key, 0) + 1
+        for (attribute_name, label), count in sorted(counts.items()):
+            print(f"{attribute_name:12s} {label:10s} {count}")
+        print(f"{sum(counts.values())} templates in {index_path}")
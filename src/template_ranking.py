@@ -0,0 +1,135 @@
+#!/bin/python3
+
+# Order templates by how often they won before, so the template that
+# is most likely to match is tried first and the search can stop early.
+# Wins are counted per template and saved between runs, so the order
+# follows the pikmin that are actually in the collection. The counts are
+# kept in SQLite and only ever incremented there, so worker processes
+# can save at the same time.
+
+import numpy as np
+
+import hashlib
+import os
+import sqlite3
+
+stats_path = "../cache/template_ranking.sqlite"
+
+# Wins and matches since the last save, added to the database when saving
+_new_wins = {}
+_new_totals = {}
+
+# Counters for the current process, {attribute name: {"pikmin", "matches"}}
+stats = {}
+
+# Connection for this process, opened when first needed
+_connection = None
+# Saved wins of each attribute, {attribute name: {template id: wins}},
+# read when first needed and again after saving
+_saved_wins = {}
+
+# Stable id of a template, taken from its pixels
+def template_id(template):
+    return hashlib.sha1(np.ascontiguousarray(template).tobytes()).hexdigest()[:16]
+
+def get_connection():
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(stats_path), exist_ok=True)
+        # Several worker processes save at once, wait for their writes
+        _connection = sqlite3.connect(stats_path, timeout=30)
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS wins (
+                attribute TEXT NOT NULL,
+                template TEXT NOT NULL,
+                wins INTEGER NOT NULL,
+                PRIMARY KEY (attribute, template)
+            )""")
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS totals (
+                attribute TEXT PRIMARY KEY,
+                pikmin INTEGER NOT NULL,
+                matches INTEGER NOT NULL
+            )""")
+        _connection.commit()
+
+    return _connection
+
+# Close the connection, e.g. before changing stats_path
+def close():
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
+    _saved_wins.clear()
+
+def _load_wins(attribute_name):
+    if attribute_name not in _saved_wins:
+        rows = get_connection().execute("SELECT template, wins FROM wins WHERE attribute = ?", (attribute_name,))
+        _saved_wins[attribute_name] = dict(rows.fetchall())
+
+    return _saved_wins[attribute_name]
+
+# Get (key, template id, template) for every template in a template
+# dictionary, the ones that won most often first. Ties keep the order
+# of the dictionary
+def rank(attribute_name, templates):
+    wins = dict(_load_wins(attribute_name))
+    for key, count in _new_wins.get(attribute_name, {}).items():
+        wins[key] = wins.get(key, 0) + count
+
+    ranked = [(key, template_id(template), template) for key, val in templates.items() for template in val]
+    ranked.sort(key=lambda entry: -wins.get(entry[1], 0))
+
+    return ranked
+
+# Count the template that decided a pikmin
+def record_win(attribute_name, template_key):
+    attribute_wins = _new_wins.setdefault(attribute_name, {})
+    attribute_wins[template_key] = attribute_wins.get(template_key, 0) + 1
+
+# Count how many template matches it took to classify some pikmin
+def record_matches(attribute_name, pikmin_count, match_count):
+    for counters in [stats.setdefault(attribute_name, {"pikmin": 0, "matches": 0}),
+                     _new_totals.setdefault(attribute_name, {"pikmin": 0, "matches": 0})]:
+        counters["pikmin"] += pikmin_count
+        counters["matches"] += match_count
+
+# Add everything counted since the last save to the saved statistics.
+# The counts are incremented inside the database in one transaction, so
+# processes saving at the same time never lose each other's counts
+def save():
+    if len(_new_wins) == 0 and len(_new_totals) == 0:
+        return
+
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            "INSERT INTO wins VALUES (?, ?, ?) "
+            "ON CONFLICT (attribute, template) DO UPDATE SET wins = wins + excluded.wins",
+            [(attribute_name, key, count) for attribute_name, attribute_wins in _new_wins.items()
+             for key, count in attribute_wins.items()])
+        connection.executemany(
+            "INSERT INTO totals VALUES (?, ?, ?) "
+            "ON CONFLICT (attribute) DO UPDATE SET pikmin = pikmin + excluded.pikmin, "
+            "matches = matches + excluded.matches",
+            [(attribute_name, counters["pikmin"], counters["matches"])
+             for attribute_name, counters in _new_totals.items()])
+    _new_wins.clear()
+    _new_totals.clear()
+    # Read again when next ranking, with the wins other processes saved
+    _saved_wins.clear()
+
+# Print the average number of template matches per pikmin,
+# for this process and for every saved run
+def print_stats():
+    for attribute_name, counters in stats.items():
+        if counters["pikmin"] > 0:
+            print(f"{attribute_name.capitalize()} template matches per pikmin: "
+                  f"{counters['matches'] / counters['pikmin']:.2f} ({counters['pikmin']} pikmin)")
+
+    for attribute_name, pikmin, matches in get_connection().execute(
+            "SELECT attribute, pikmin, matches FROM totals ORDER BY rowid"):
+        if pikmin > 0:
+            print(f"{attribute_name.capitalize()} template matches per pikmin over all runs: "
+                  f"{matches / pikmin:.2f} ({pikmin} pikmin)")
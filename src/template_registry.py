@@ -0,0 +1,114 @@
+#!/bin/python3
+
+# Process-wide cache of grayscale templates so every Pikmin
+# does not re-read and re-convert the template images from disk
+
+from skimage.io import imread
+from skimage.color import rgb2gray
+
+import profiler
+
+# Grayscale image for each template file, keyed by path
+_file_cache = {}
+# Assembled template dictionary for each attribute, keyed by attribute name
+_attribute_cache = {}
+# Functions that build the template dictionary for an attribute
+_loaders = {}
+
+# Size of the screen being scanned relative to the screen the templates
+# were made on. Templates for other scales are resized once and cached
+scale = 1.0
+
+# Counters to confirm the cache is being used
+stats = {
+    "file_loads": 0,
+    "file_hits": 0,
+    "attribute_loads": 0,
+    "attribute_hits": 0,
+}
+profiler.register_counters("template_registry", stats,
+                           {"template file": ("file_hits", "file_loads"),
+                            "template set": ("attribute_hits", "attribute_loads")})
+
+# Register the function used to build the templates for an attribute
+def register_loader(attribute_name, loader):
+    _loaders[attribute_name] = loader
+    invalidate(attribute_name)
+
+# Load a single template file as grayscale, only reading
+# the file from disk the first time it is requested
+def load_template_file(path):
+    if path in _file_cache:
+        stats["file_hits"] += 1
+        return _file_cache[path]
+
+    image = imread(path)
+    # Drop alpha channel if there is one
+    if image.ndim == 3:
+        image = rgb2gray(image[...,0:3])
+    _file_cache[path] = image
+    stats["file_loads"] += 1
+
+    return image
+
+# Set the scale templates are returned at
+def set_scale(new_scale):
+    global scale
+    scale = round(new_scale, 3)
+
+# Resize every template in a template dictionary
+def _rescale_templates(templates, template_scale):
+    # skimage.transform is slow to import and only needed for screens
+    # of another size, so only load it then
+    from skimage.transform import rescale
+
+    scaled = {}
+    for key, val in templates.items():
+        if isinstance(val, list):
+            scaled[key] = [rescale(template, template_scale, anti_aliasing=True) for template in val]
+        else:
+            scaled[key] = rescale(val, template_scale, anti_aliasing=True)
+
+    return scaled
+
+# Get the template dictionary for an attribute, building it
+# with the registered loader if it is not cached
+def get_templates(attribute_name):
+    cache_key = attribute_name if scale == 1 else (attribute_name, scale)
+    if cache_key in _attribute_cache:
+        stats["attribute_hits"] += 1
+        return _attribute_cache[cache_key]
+
+    if scale == 1:
+        templates = _loaders[attribute_name]()
+    else:
+        # Resize from the full size templates, which are cached too
+        target_scale = scale
+        set_scale(1)
+        templates = _rescale_templates(get_templates(attribute_name), target_scale)
+        set_scale(target_scale)
+    _attribute_cache[cache_key] = templates
+    stats["attribute_loads"] += 1
+
+    return templates
+
+# Drop the cached template dictionary for an attribute at every scale.
+# Files that were already loaded stay cached, so rebuilding only reads new files
+def invalidate(attribute_name, path=None):
+    for cache_key in list(_attribute_cache):
+        if cache_key == attribute_name or (isinstance(cache_key, tuple) and cache_key[0] == attribute_name):
+            del _attribute_cache[cache_key]
+    if path is not None:
+        _file_cache.pop(path, None)
+
+# Drop everything, used when the template directory changes underneath us
+def clear():
+    _file_cache.clear()
+    _attribute_cache.clear()
+    for key in stats:
+        stats[key] = 0
+
+# Print the cache counters
+def print_stats():
+    print(f"Template files loaded: {stats['file_loads']}, file cache hits: {stats['file_hits']}")
+    print(f"Template sets built: {stats['attribute_loads']}, set cache hits: {stats['attribute_hits']}")
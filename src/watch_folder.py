@@ -0,0 +1,140 @@
+#!/bin/python3
+
+# Watch folders for new screenshots and identify each one as soon as it
+# has been written, keeping the templates and caches loaded between
+# screenshots. The folders are polled, so synced and network folders
+# work too and nothing beyond the standard library is needed.
+
+import os
+import time
+
+import batch_scan
+import profiler
+
+# Seconds between looking at the folders
+poll_interval = 0.1
+# Seconds the size and modification time of a file must stay the same
+# before it is read, so files that are still being synced are skipped
+settle_time = 0.2
+# Times a file that cannot be read is tried again before giving up on it
+max_attempts = 5
+
+extensions = (".jpg", ".jpeg", ".png")
+
+class FolderWatcher:
+    def __init__(self, directories, include_existing=False):
+        self.directories = directories
+        # (size, modification time) of each file and when it was first
+        # seen like that, for files that were not scanned yet
+        self.pending = {}
+        # (size, modification time) of each file when it was scanned.
+        # A file that changes afterwards is scanned again
+        self.done = {}
+        # Failed reads of each file
+        self.attempts = {}
+
+        if not include_existing:
+            for path, stat in self.list_files():
+                self.done[path] = (stat.st_size, stat.st_mtime_ns)
+
+    # Get (path, stat) of every screenshot in the folders
+    def list_files(self):
+        files = []
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.name.lower().endswith(extensions) and entry.is_file():
+                    try:
+                        files.append((entry.path, entry.stat()))
+                    except FileNotFoundError:
+                        # Removed while listing
+                        pass
+
+        return files
+
+    # Paths of new or changed screenshots that have not changed for settle_time
+    def ready_files(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        ready = []
+        present = set()
+        for path, stat in self.list_files():
+            present.add(path)
+            key = (stat.st_size, stat.st_mtime_ns)
+            if stat.st_size == 0 or self.done.get(path) == key:
+                continue
+            if path not in self.pending or self.pending[path][0] != key:
+                self.pending[path] = (key, now)
+            elif now - self.pending[path][1] >= settle_time:
+                ready.append(path)
+
+        # Forget files that were removed before they were scanned
+        for path in list(self.pending):
+            if path not in present:
+                del self.pending[path]
+                self.attempts.pop(path, None)
+
+        return sorted(ready)
+
+    def mark_done(self, path):
+        self.done[path] = self.pending.pop(path)[0]
+        self.attempts.pop(path, None)
+
+    # Try a file again once it has settled again, returning
+    # False if it failed too many times and was given up on
+    def mark_failed(self, path):
+        self.attempts[path] = self.attempts.get(path, 0) + 1
+        if self.attempts[path] >= max_attempts:
+            self.mark_done(path)
+            return False
+
+        key, _ = self.pending[path]
+        self.pending[path] = (key, time.monotonic())
+        return True
+
+# Identify screenshots as they are added to the folders until interrupted
+# or stop returns True. Records are written with the writer as each
+# screenshot is identified, dropping pikmin already seen if a
+# deduplicator is given
+def watch(directories, writer=None, headless=False, cache=True, deduplicator=None, include_existing=False, stop=None,
+          decor=False):
+    batch_scan.init_worker(headless, cache, decor)
+    watcher = FolderWatcher(directories, include_existing)
+    print(f"Watching {', '.join(directories)} for new screenshots, press Ctrl+C to stop")
+
+    scanned = 0
+    try:
+        while stop is None or not stop():
+            for path in watcher.ready_files():
+                try:
+                    path, records, elapsed, measured = batch_scan.scan_file(path)
+                except Exception as error:
+                    # A file that is still being written may look settled,
+                    # and one bad screenshot must not stop the watcher
+                    if watcher.mark_failed(path):
+                        print(f"Could not scan {path} ({error}), trying again")
+                    else:
+                        print(f"Could not scan {path} ({error}), skipping it")
+                    continue
+                watcher.mark_done(path)
+                profiler.merge(measured)
+                scanned += 1
+
+                if deduplicator is not None:
+                    records = deduplicator.filter(records)
+                if writer is not None:
+                    writer.write(records)
+                # Time from the file being written to its result being stored
+                latency = time.time() - watcher.done[path][1] / 1e9
+                print(f"{elapsed:7.2f}s  {len(records):3d} pikmin  {path}  ({latency:.2f}s after it was written)")
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print()
+
+    print(f"Scanned {scanned} screenshots")
+
+    return scanned